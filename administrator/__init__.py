@@ -1,14 +1,30 @@
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, _app_ctx_stack, jsonify, make_response
+     render_template, flash, _app_ctx_stack, jsonify, make_response, Response
 from contextlib import closing # TODO: remove this?
-from datetime import datetime, timedelta
-from crossdomain import crossdomain
+from crossdomain import crossdomain, Preflight
+from expiry import epoch_now
+from pool import JobPool
+from connections import ConnectionPool, open_connection
+from collector import Collector
+from waiters import Waiters
+from metrics import Metrics
+from profiling import Profiler, TracedConnection
+from claimants import ClaimantCache
+from shards import ShardSet, shard_key, shard_path, shard_files
+import archiver
+import dump
+import migrate
+import payloads
+import results
+import atexit
 import sqlite3
 import hashlib
 import json
 import uuid
 import os
+import random
 import threading
+import time
 app = Flask(__name__)
 
 
@@ -28,9 +44,47 @@ Embedded config
 """
 
 DATABASE = '/tmp/administrator.db'
+ENGINE = 'sqlite' # or 'memory' to serve jobs from an in-process pool
+# applied in name order, so auto_vacuum comes before journal_mode
+# and takes effect on a new database
+SQLITE_PRAGMAS = {'auto_vacuum': 'INCREMENTAL',
+                  'journal_mode': 'WAL',
+                  'synchronous': 'NORMAL',
+                  'mmap_size': 64 * 1024 * 1024,
+                  'cache_size': -16 * 1024, # KiB
+                  'busy_timeout': 5000} # ms
+SQLITE_MAX_CONNECTIONS = 32 # pooled connections kept per thread, None for no limit
 PASSWORD_HASH = hash_password('fancy')
 SECRET_KEY = os.urandom(24)
 TRACK_SESSION = False
+EXPIRY_RECHECK = 5 # seconds between checks for jobs claimed by other processes
+EXPIRY_THREAD = False # expire jobs from a background thread as they fall due
+BATCH_LIMIT = 1000 # most jobs handed out by one /get_batch
+INGEST_CHUNK_SIZE = 1000 # jobs inserted per transaction by a streaming /add
+GC_BATCH_SIZE = 500 # replaced jobs deleted per background transaction
+COMPRESS_MIN_SIZE = None # store payloads of at least this many bytes zlib-compressed
+DEDUP_PAYLOADS = False # store each distinct payload once, jobs refer to it by id
+PAYLOAD_CACHE_SIZE = 1000 # deduplicated payloads kept in memory for /get
+WAIT_LIMIT = 30 # longest a /get may wait for jobs, in seconds
+WAIT_RECHECK = 1 # seconds between claim attempts while waiting
+CLAIMANT_CACHE_SIZE = 100000 # sessions whose held jobs are cached
+ARCHIVE_DATABASE = None # separate file for archived jobs, None keeps them in DATABASE
+ARCHIVE_AGE = 7 * 24 * 3600 # seconds after completion before a job is archived, None for no limit
+ARCHIVE_KEEP = None # newest completed jobs kept per pool, None for no limit
+ARCHIVE_BATCH_SIZE = 500 # jobs archived per transaction
+ARCHIVE_VACUUM_PAGES = None # pages freed per incremental vacuum, None for all
+ARCHIVE_INTERVAL = 3600 # seconds between background archive runs
+ARCHIVE_THREAD = False # archive completed jobs from a background thread
+SHARDS = None # 'id' for a database file per administrator_id, N to hash ids over N files
+PENDING_POLICY = 'random' # or 'least_claimed' to re-issue the least duplicated pending jobs first
+EXPORT_BATCH_SIZE = 1000 # jobs read per page of an export
+RESULTS_BATCH_SIZE = 1000 # results read per page of /results
+GROUP_COMMIT = False # commit claims, confirms and heartbeats in batches from one thread
+GROUP_COMMIT_INTERVAL = 0.002 # seconds a batch waits for more writes
+GROUP_COMMIT_SIZE = 100 # most writes in one batch
+PROFILE = False # profile every request, or only those with the password in X-Administrator-Profile
+PROFILE_DIR = '/tmp/administrator-profiles' # where per endpoint profiles are written
+PROFILE_WRITE_INTERVAL = 60 # seconds between writes of the profiles to PROFILE_DIR
 
 """
 Set up as app
@@ -38,15 +92,28 @@ Set up as app
 app = Flask(__name__)
 app.config.from_object(__name__)
 app.config.from_envvar('ADMINISTRATOR_SETTINGS', silent=True)
+# CORS preflights are answered before they reach Flask's routing
+app.wsgi_app = Preflight(app)
 
 """
 Locks
 
 Wanted to avoid this but was spending too much time on
 debugging atomicity in sqlite3
+
+get_lock only serializes threads within one process. What keeps
+claims unique across several server processes is that each claim
+runs in a BEGIN IMMEDIATE transaction, which holds SQLite's write
+lock from the first SELECT until the claim is committed.
+
+Each storage shard has a get_lock of its own, see get_shard. The time
+spent waiting for and holding them is reported on /metrics. With
+GROUP_COMMIT, claims and confirms skip get_lock, as the shard's group
+committer thread already runs them one after another.
 """
 
-get_lock = threading.Lock()
+metrics = Metrics()
+shard_set = ShardSet(metrics, app.config['EXPIRY_RECHECK'])
 
 """
 Initialize, connect to the db
@@ -56,32 +123,346 @@ transactions if one does not already exist
 
 def init_db():
     """Creates the database tables."""
+    close_pool()
+    shard_set.forget(main_shard())
+    claimants.clear()
+    payload_cache.clear()
+    db_pool.close_all()
     with app.app_context():
-        db = get_db()
-        with app.open_resource('schema/administrator.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        db.commit()
+        create_tables(get_db())
 
+def create_tables(db):
+    """Creates db's tables, rebuilding a jobs table left by an older
+    version of the schema.
+    """
+    with app.open_resource('schema/administrator.sql', mode='r') as f:
+        schema = f.read()
+    if migrate.outdated(db, schema):
+        migrate.set_aside(db, schema)
+    db.cursor().executescript(schema)
+    db.commit()
+    migrate.copy_jobs(db, epoch_now())
 
-def get_db():
-    """Opens a new database connection if there is none yet for the
-    current application context.
+@app.before_first_request
+def upgrade_db():
+    """Creates DATABASE's tables, migrating those of an older version,
+    before this process serves its first request.
     """
+    create_tables(get_db())
+
+
+db_pool = ConnectionPool()
+
+def get_db(database=None):
+    """Borrows this thread's pooled connection to database, DATABASE by
+    default, for the current application context.
+    """
+    database = database or app.config['DATABASE']
     top = _app_ctx_stack.top
-    if not hasattr(top, 'sqlite_db'):
-        sqlite_db = sqlite3.connect(app.config['DATABASE'],
-                                    isolation_level=None)
-        sqlite_db.row_factory = sqlite3.Row
-        top.sqlite_db = sqlite_db
+    if not hasattr(top, 'sqlite_dbs'):
+        top.sqlite_dbs = {}
+    if database not in top.sqlite_dbs:
+        top.sqlite_dbs[database] = db_pool.connect(database,
+            app.config['SQLITE_PRAGMAS'], app.config['SQLITE_MAX_CONNECTIONS'])
+
+    spans = getattr(g, 'sql_spans', None)
+    if spans is not None:
+        return TracedConnection(top.sqlite_dbs[database], spans)
+    return top.sqlite_dbs[database]
+
+"""
+Storage shards
+
+Without SHARDS every pool is stored in DATABASE. With it, get_shard
+finds the file an administrator_id's pool is stored in, creating it
+with the schema on first use. Only the sqlite engine is sharded.
+"""
+
+def main_shard():
+    return shard_set.get(app.config['DATABASE'])[0]
+
+def database_for(aid):
+    if app.config['SHARDS'] is None:
+        return app.config['DATABASE']
+    return shard_path(app.config['DATABASE'],
+                      shard_key(aid, app.config['SHARDS']))
+
+def get_shard(aid, create=True):
+    """Returns the Shard holding aid's pool. Returns None instead of
+    creating a shard file that does not exist yet, unless create.
+    """
+    database = database_for(aid)
+    if database == app.config['DATABASE']:
+        return main_shard()
+
+    if not create and not os.path.exists(database):
+        return None
+    return open_shard(database)
+
+def open_shard(database):
+    """Returns the Shard of a shard file, creating or migrating its
+    tables the first time this process opens it.
+    """
+    shard, new = shard_set.get(database)
+    if new:
+        create_tables(get_db(database))
+        if app.config['EXPIRY_THREAD']:
+            start_expiry_thread_for(shard)
+    return shard
+
+def all_databases():
+    """Returns the (shard key, path) of DATABASE and every shard file."""
+    return [(None, app.config['DATABASE'])] + shard_files(app.config['DATABASE'])
+
+"""
+In-memory engine
+
+With ENGINE = 'memory' jobs are served from a JobPool that is loaded
+from the database on first use and journals every change back to it.
+"""
+
+job_pool = None
+job_pool_lock = threading.Lock()
+
+def use_pool():
+    return app.config['ENGINE'] == 'memory'
+
+def get_pool():
+    """Returns the in-memory pool, loading it from the database if needed."""
+    global job_pool
+    with job_pool_lock:
+        if job_pool is None:
+            job_pool = JobPool(app.config['DATABASE'],
+                               app.config['COMPRESS_MIN_SIZE'], waiters,
+                               app.config['PENDING_POLICY'])
+        return job_pool
+
+@atexit.register
+def close_pool():
+    """Flushes the in-memory pool's journal and drops the pool."""
+    global job_pool
+    with job_pool_lock:
+        if job_pool is not None:
+            job_pool.close()
+            job_pool = None
+
+def write_transaction(db, f, *args):
+    """Runs f(cursor, *args) inside a BEGIN IMMEDIATE transaction and
+    returns its result, rolling back if it raises.
+    """
+    with closing(db.cursor()) as c:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            result = f(c, *args)
+        except:
+            rollback(c)
+            raise
 
-    return top.sqlite_db
+        c.execute("COMMIT")
+        return result
+
+def commit(shard, f, *args):
+    """Runs f(cursor, *args) in a write transaction on shard's database
+    and returns its result. With GROUP_COMMIT, f joins the next batch of
+    the shard's group committer instead of committing on its own.
+    """
+    if app.config['GROUP_COMMIT']:
+        committer = shard.group_committer(app.config['SQLITE_PRAGMAS'],
+                                          app.config['GROUP_COMMIT_INTERVAL'],
+                                          app.config['GROUP_COMMIT_SIZE'])
+        return committer.submit(f, *args)
+
+    with shard.lock:
+        return write_transaction(get_db(shard.database), f, *args)
+
+def rollback(c):
+    """Rolls back the open transaction, if the failure left one open."""
+    try:
+        c.execute("ROLLBACK")
+    except sqlite3.OperationalError:
+        pass
 
 @app.teardown_appcontext
 def close_db_connection(exception):
-    """Closes the database again at the end of the request."""
+    """Hands the connection back to the pool at the end of the request,
+    making sure a failed request has not left a transaction open.
+    """
     top = _app_ctx_stack.top
-    if hasattr(top, 'sqlite_db'):
-        top.sqlite_db.close()
+    if hasattr(top, 'sqlite_dbs') and exception is not None:
+        for db in top.sqlite_dbs.values():
+            rollback(db)
+    db_pool.release()
+
+@app.route("/db_stats")
+@crossdomain(origin='*')
+def db_stats():
+    return jsonify(db_pool.stats())
+
+"""
+Metrics
+
+Request latencies, get_lock contention, expiry counts and per pool job
+gauges, in the Prometheus text format. Everything is counted in memory
+as it happens, except the sqlite engine's job gauges, which are read
+from pool_counts.
+"""
+
+metrics.describe('administrator_request_seconds', 'histogram',
+                 'Time to serve a request, by route.')
+metrics.describe('administrator_lock_wait_seconds', 'histogram',
+                 'Time spent waiting to acquire a lock.')
+metrics.describe('administrator_lock_held_seconds', 'histogram',
+                 'Time a lock was held for.')
+metrics.describe('administrator_expired_jobs_total', 'counter',
+                 'Pending jobs returned to the ready pool by expiry.')
+metrics.describe('administrator_jobs', 'gauge',
+                 'Jobs in the active pool, by administrator_id and status.')
+metrics.describe('administrator_claimant_cache_hits_total', 'counter',
+                 'Session lookups answered by the claimant cache.')
+metrics.describe('administrator_claimant_cache_misses_total', 'counter',
+                 'Session lookups that had to search the jobs_claimant index.')
+metrics.describe('administrator_payload_cache_hits_total', 'counter',
+                 'Deduplicated payloads answered by the payload cache.')
+metrics.describe('administrator_payload_cache_misses_total', 'counter',
+                 'Deduplicated payloads that had to be read from the payloads table.')
+metrics.describe('administrator_waiting_requests', 'gauge',
+                 'Requests waiting for jobs to become available.')
+
+@app.before_request
+def start_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_latency(response):
+    if request.url_rule is not None and hasattr(g, 'request_start'):
+        metrics.observe('administrator_request_seconds',
+                        time.time() - g.request_start, route=request.url_rule.rule)
+    return response
+
+"""
+Profiling
+
+See profiling.py. The SQL statements of a profiled request are timed
+through the connections get_db hands out; the group committer's and
+background threads' connections are not.
+"""
+
+profiler = Profiler()
+profile_writer = None
+profile_writer_lock = threading.Lock()
+
+@atexit.register
+def write_profiles():
+    try:
+        profiler.write(app.config['PROFILE_DIR'])
+    except Exception,e:
+        print str(e)
+
+def write_profiles_forever():
+    while True:
+        time.sleep(app.config['PROFILE_WRITE_INTERVAL'])
+        write_profiles()
+
+def start_profile_writer():
+    global profile_writer
+    with profile_writer_lock:
+        if profile_writer is None:
+            profile_writer = threading.Thread(target=write_profiles_forever)
+            profile_writer.daemon = True
+            profile_writer.start()
+
+@app.before_request
+def start_profile():
+    header = request.headers.get('X-Administrator-Profile')
+    if app.config['PROFILE'] or (header is not None and
+            hash_password(header) == app.config['PASSWORD_HASH']):
+        start_profile_writer()
+        g.profile, g.sql_spans = profiler.start()
+
+@app.after_request
+def finish_profile(response):
+    if getattr(g, 'profile', None) is not None:
+        profiler.finish(request.endpoint or 'unknown', g.profile, g.sql_spans)
+        if g.sql_spans.spans:
+            response.headers['Server-Timing'] = g.sql_spans.server_timing()
+        g.profile = g.sql_spans = None
+    return response
+
+@app.teardown_request
+def stop_profile(exception):
+    # after_request is skipped when the view raises
+    if getattr(g, 'profile', None) is not None:
+        g.profile.disable()
+
+@app.route("/metrics")
+def metrics_text():
+    if use_pool():
+        pool = get_pool()
+        pools = pool.stats()
+        gauges = [('administrator_expired_jobs_total', {}, pool.expired)]
+    else:
+        pools = []
+        for key, database in all_databases():
+            pools.extend(read_pool_counts(get_db(database)))
+        gauges = [('administrator_claimant_cache_hits_total', {}, claimants.hits),
+                  ('administrator_claimant_cache_misses_total', {}, claimants.misses),
+                  ('administrator_payload_cache_hits_total', {}, payload_cache.hits),
+                  ('administrator_payload_cache_misses_total', {}, payload_cache.misses)]
+
+    gauges.append(('administrator_waiting_requests', {}, waiters.waiting))
+    for aid, counts in pools:
+        for status, count in counts.items():
+            gauges.append(('administrator_jobs',
+                           {'administrator_id': aid, 'status': status}, count))
+
+    return Response(metrics.render(gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+"""
+Pool counts
+
+The ready, pending and complete jobs of every generation are counted
+in pool_counts by triggers on the jobs table, so reading a pool's
+progress is a primary key lookup rather than a scan of its jobs.
+"""
+
+def read_pool_counts(c, aid=None):
+    """Returns (administrator_id, counts) for the active generation of
+    aid's pool, or of every pool.
+    """
+    sql = "SELECT p.administrator_id, p.ready, p.pending, p.complete \
+        FROM pool_counts p WHERE p.generation = COALESCE((SELECT active FROM generations \
+            WHERE generations.administrator_id = p.administrator_id), 0)"
+    if aid is None:
+        rows = c.execute(sql).fetchall()
+    else:
+        rows = c.execute(sql + " and p.administrator_id=?", (aid,)).fetchall()
+
+    return [(row[0], {'ready': row[1], 'pending': row[2], 'complete': row[3]})
+            for row in rows]
+
+@app.route("/stats")
+@crossdomain(origin='*')
+def stats():
+    aid = request.args.get('administrator_id')
+    if use_pool():
+        pools = get_pool().stats(aid)
+    elif aid is not None:
+        shard = get_shard(aid, create=False)
+        pools = [] if shard is None else \
+            read_pool_counts(get_db(shard.database), aid)
+    else:
+        pools = []
+        for key, database in all_databases():
+            pools.extend(read_pool_counts(get_db(database)))
+
+    if aid is not None:
+        counts = dict(pools[0][1]) if pools else \
+            {'ready': 0, 'pending': 0, 'complete': 0}
+        counts['administrator_id'] = aid
+        return jsonify(counts)
+
+    return jsonify(pools=dict(pools))
 
 """
 Add jobs to the db
@@ -92,127 +473,744 @@ Add jobs to the db
 def hello_world():
     return "Hello world"
 
-def delete_jobs(c, aid):
-    return c.execute("DELETE FROM jobs WHERE administrator_id=?", (aid,))
+"""
+Random job selection
+
+Every job carries a rand_key drawn uniformly from [0, 1) and
+re-drawn whenever the job changes hands. Picking the first job at
+or after a random point in the (administrator_id, status, rand_key)
+index is a single index seek, and because the keys are themselves
+random the pick is uniform over the pool. Taking the next few jobs
+along the index gives a random batch.
+"""
+
+RANDOM_KEY = "(random() / 18446744073709551616.0 + 0.5)"
+
+def select_random_jobs(c, aid, generation, status, count, exclude=()):
+    """Returns up to count random (id, payload, timeout) rows, skipping
+    the ids in exclude.
+    """
+    point = random.random()
+    limit = count + len(exclude)
+
+    c.execute("SELECT id, COALESCE(json, payload_id), timeout FROM jobs \
+        WHERE administrator_id=? and generation=? and status=? and rand_key >= ? ORDER BY rand_key LIMIT ?",
+        (aid, generation, status, point, limit))
 
-def append_jobs(c, insert_tuples):
-    return c.executemany("INSERT INTO jobs (administrator_id, json, timeout, status) \
-                            VALUES (?, ?, ?, 'ready')", insert_tuples)
+    rows = c.fetchall()
+    if len(rows) < limit:
+        # wrap around to the start of the index
+        c.execute("SELECT id, COALESCE(json, payload_id), timeout FROM jobs \
+            WHERE administrator_id=? and generation=? and status=? and rand_key < ? ORDER BY rand_key LIMIT ?",
+            (aid, generation, status, point, limit - len(rows)))
 
-def replace_jobs(c, aid, insert_tuples):
-    delete_jobs(c, aid)
-    append_jobs(c, insert_tuples)
+        rows += c.fetchall()
+
+    return [tuple(r) for r in rows if r[0] not in exclude][:count]
+
+def select_least_claimed_jobs(c, aid, generation, count, exclude=()):
+    """Returns up to count pending (id, payload, timeout) rows, those
+    handed out the fewest times first and, among them, those closest
+    to expiring.
+    """
+    c.execute("SELECT id, COALESCE(json, payload_id), timeout FROM jobs \
+        WHERE administrator_id=? and generation=? and status='pending' ORDER BY claims, expire_time LIMIT ?",
+        (aid, generation, count + len(exclude)))
+
+    return [tuple(r) for r in c.fetchall() if r[0] not in exclude][:count]
+
+def select_random_pending_jobs(c, aid, generation, count, exclude=()):
+    return select_random_jobs(c, aid, generation, 'pending', count, exclude)
+
+# how claim_jobs picks pending jobs once no ready ones are left
+PENDING_POLICIES = {'random': select_random_pending_jobs,
+                    'least_claimed': select_least_claimed_jobs}
+
+def select_random_job(c, aid, status):
+    rows = select_random_jobs(c, aid, active_generation(c, aid), status, 1)
+    return rows[0] if rows else None
+
+"""
+Generations
+
+Each administrator_id's jobs belong to a generation, and only the
+active generation is visible. Replacing a pool adds the new jobs under
+a fresh generation, switches the active generation in one statement,
+and leaves the old rows to be deleted in the background, so claims see
+either the old pool or the new one and never wait on the rewrite.
+"""
+
+def active_generation(c, aid):
+    c.execute("SELECT active FROM generations WHERE administrator_id=?", (aid,))
+    c_res = c.fetchone()
+    return 0 if c_res is None else c_res[0]
+
+def stage_generation(c, aid):
+    """Reserves a new, not yet visible, generation for aid."""
+    c.execute("INSERT OR IGNORE INTO generations (administrator_id, active, latest) \
+        VALUES (?, 0, 0)", (aid,))
+    c.execute("UPDATE generations SET latest=latest + 1 WHERE administrator_id=?",
+        (aid,))
+    c.execute("SELECT latest FROM generations WHERE administrator_id=?", (aid,))
+    return c.fetchone()[0]
+
+def activate_generation(c, aid, generation):
+    c.execute("UPDATE generations SET active=? WHERE administrator_id=? \
+        and active < ?", (generation, aid, generation))
+
+collector = None
+collector_lock = threading.Lock()
+
+def get_collector():
+    global collector
+    with collector_lock:
+        if collector is None:
+            collector = Collector(app.config['GC_BATCH_SIZE'])
+            collector.start()
+    return collector
+
+def collect_generations(database, aid, generation):
+    """Deletes aid's jobs from before generation in the background."""
+    get_collector().collect(database,
+        "SELECT id FROM jobs WHERE administrator_id=? and generation < ?",
+        (aid, generation))
+
+def discard_generation(database, aid, generation):
+    """Deletes the jobs of a staged generation that will never be
+    activated, in the background.
+    """
+    get_collector().collect(database,
+        "SELECT id FROM jobs WHERE administrator_id=? and generation=?",
+        (aid, generation))
+
+@app.before_first_request
+def collect_old_generations():
+    """Queues the deletion of every pool's replaced generations, which a
+    restart may have left behind.
+    """
+    for key, database in all_databases():
+        if key is not None:
+            open_shard(database)
+        db = get_db(database)
+        for aid, active in db.execute("SELECT administrator_id, active \
+                FROM generations WHERE active > 0").fetchall():
+            if db.execute("SELECT 1 FROM jobs WHERE administrator_id=? \
+                    and generation < ? LIMIT 1", (aid, active)).fetchone():
+                collect_generations(database, aid, active)
+
+def append_jobs(c, insert_tuples, generation=0):
+    """Inserts ready jobs from (administrator_id, json, payload_id,
+    timeout) tuples.
+    """
+    return c.executemany("INSERT INTO jobs (administrator_id, json, payload_id, \
+                            timeout, status, generation) VALUES (?, ?, ?, ?, 'ready', ?)",
+                            (t + (generation,) for t in insert_tuples))
+
+def stored_payloads(c, chunk):
+    """Returns the (json, payload_id) each payload of chunk is stored
+    as. With DEDUP_PAYLOADS the payloads go to the payloads table and
+    the jobs refer to them.
+    """
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    if app.config['DEDUP_PAYLOADS']:
+        return [(None, payload_id)
+                for payload_id in payloads.store(c, chunk, min_size)]
+
+    return [(payloads.encode(payload, min_size), None) for payload in chunk]
+
+def job_tuples(c, aid, chunk, timeout):
+    """The insert tuples for a chunk of payloads."""
+    return [(aid, json_text, payload_id, timeout)
+            for json_text, payload_id in stored_payloads(c, chunk)]
+
+ADD_MODES = ('append', 'replace', 'populate')
+
+def add_jobs(c, aid, mode, chunk, timeout, generation=None):
+    if mode == 'replace':
+        # into the staged generation, which add_chunks activates at the end
+        append_jobs(c, job_tuples(c, aid, chunk, timeout), generation)
+        return "Jobs replaced"
+
+    generation = active_generation(c, aid)
+    if mode == 'append':
+        append_jobs(c, job_tuples(c, aid, chunk, timeout), generation)
+        return "Jobs appended"
+    elif mode == 'populate':
+        # archived jobs count, or a drained pool would be refilled
+        c.execute("SELECT EXISTS (SELECT 1 FROM pool_counts WHERE administrator_id=? \
+            and generation=? and ready + pending + complete > 0) \
+            OR EXISTS (SELECT 1 FROM archived_counts \
+            WHERE administrator_id=? and generation=?)",
+            (aid, generation, aid, generation))
+
+        if not c.fetchone()[0]:
+            append_jobs(c, job_tuples(c, aid, chunk, timeout), generation)
+            return "Jobs appended"
+        else:
+            return "Not repopulating jobs"
+
+def add_chunks(aid, mode, timeout, chunks):
+    """Adds jobs one chunk of payloads at a time. Each chunk gets its
+    own transaction, so claims can run in between. Returns the message
+    for the first chunk, or None on failure, and the number of jobs added.
+    """
+    if use_pool():
+        return get_pool().add_chunks(aid, mode, timeout, chunks)
+
+    shard = get_shard(aid)
+    db = get_db(shard.database)
+    message = None
+    count = 0
+    generation = None
+
+    try:
+        if mode == 'replace':
+            generation = write_transaction(db, stage_generation, aid)
+
+        for chunk in chunks:
+            with shard.lock:
+                chunk_message = write_transaction(db, add_jobs, aid, mode,
+                                                  chunk, timeout, generation)
+
+            if chunk_message == "Not repopulating jobs":
+                return chunk_message, count
+
+            if generation is None:
+                waiters.notify(aid)
+            message = message or chunk_message
+            count += len(chunk)
+            if mode == 'populate':
+                # later chunks add to what the first one set up
+                mode = 'append'
+
+        if generation is not None:
+            write_transaction(db, activate_generation, aid, generation)
+            waiters.notify(aid)
+            collect_generations(shard.database, aid, generation)
+    except sqlite3.Error, e:
+        print str(e)
+        return None, count
+
+    return message, count
+
+def chunked(iterable, size):
+    """Yields lists of up to size items, and always at least one list."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    yield chunk
 
 @app.route("/add", methods=['POST'])
 @crossdomain(origin='*', headers='Content-Type')
 def add():
+    if request.mimetype == 'application/x-ndjson':
+        return add_stream()
+
     if hash_password(request.json['password']) == app.config['PASSWORD_HASH']:
         jobs = request.json['jobs']
 
         timeout = request.json['timeout']
         mode = request.json['mode']
         aid = request.json['administrator_id']
-        insert_tuples = [(aid,
-                          json.dumps(j),
-                          timeout) for j in jobs]
-        db = get_db()
-
-        with get_lock:
-            with closing(db.cursor()) as c:
-                try:
-                    if mode == 'append':
-                        append_jobs(c, insert_tuples)
-                        return "Jobs appended"
-                    elif mode == 'replace':
-                        replace_jobs(c, aid, insert_tuples)
-                        return "Jobs replaced"
-                    elif mode == 'populate':
-                        c.execute("SELECT COUNT(id) FROM jobs WHERE administrator_id=?",
-                            (aid,))
-
-                        count = c.fetchone()[0]
-
-                        if(count) == 0:
-                            append_jobs(c, insert_tuples)
-                            return "Jobs appended"
-                        else:
-                            return "Not repopulating jobs"
-
-                except Exception,e:
-                    print str(e)
-        
+
+        if mode not in ADD_MODES:
+            return make_response("Unknown mode", 400)
+
+        message, count = add_chunks(aid, mode, timeout,
+                                    [[json.dumps(j) for j in jobs]])
+        if message is None:
+            return make_response("Jobs not added", 500)
+
+        return message
     else:
         return make_response("Password invalid", 403)
 
+def add_stream():
+    """
+    Streaming ingest: the body is NDJSON, a header object with the
+    password, administrator_id, timeout and mode followed by one job
+    per line. Jobs are read and inserted INGEST_CHUNK_SIZE at a time,
+    so memory use does not grow with the upload.
+    """
+    lines = (line.strip() for line in request.stream)
+    lines = (line for line in lines if line)
 
-def expire_jobs(db):
-    timestamp = datetime.utcnow()
-    
-    with closing(db.cursor()) as c:
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        return make_response("Missing header line", 400)
+
+    if hash_password(header['password']) != app.config['PASSWORD_HASH']:
+        return make_response("Password invalid", 403)
+
+    mode = header['mode']
+    if mode not in ADD_MODES:
+        return make_response("Unknown mode", 400)
+
+    def jobs():
+        for line in lines:
+            json.loads(line) # only store jobs that are valid JSON
+            yield line
+
+    try:
+        message, count = add_chunks(header['administrator_id'], mode,
+            header['timeout'],
+            chunked(jobs(), app.config['INGEST_CHUNK_SIZE']))
+    except ValueError:
+        return make_response("Invalid job, earlier chunks were added", 400)
+
+    if message is None:
+        return make_response("Jobs not added after %d jobs" % count, 500)
+
+    return "%s (%d jobs)" % (message, count)
+
+
+"""
+Export and import
+
+A pool's active generation can be dumped as NDJSON with its statuses
+and leases, and loaded again into this or another instance; see dump.py.
+Only the sqlite engine's pools can be dumped and loaded.
+"""
+
+def export_pool(aid):
+    """Returns an iterator over the dump lines of aid's pool."""
+    shard = get_shard(aid, create=False)
+    database = app.config['DATABASE'] if shard is None else shard.database
+    with closing(get_db(database).cursor()) as c:
+        generation = active_generation(c, aid)
+
+    return stream_lines(database, dump.export_lines, aid, generation,
+                        app.config['EXPORT_BATCH_SIZE'])
+
+def stream_lines(database, f, *args):
+    """Yields the lines of f(db, *args), read through a connection of
+    their own, as a streamed response outlives the request's.
+    """
+    with closing(open_connection(database, app.config['SQLITE_PRAGMAS'])) as db:
+        for line in f(db, *args):
+            yield line
+
+def load_jobs(c, aid, jobs, keep_ids, generation=None):
+    if generation is None:
+        generation = active_generation(c, aid)
+    stored = stored_payloads(c, [json.dumps(job['payload']) for job in jobs])
+    dump.insert_jobs(c, aid, generation, jobs, stored, keep_ids)
+
+def import_chunks(aid, mode, keep_ids, chunks):
+    """Loads dumped jobs into aid's pool a chunk at a time, each chunk
+    in its own transaction. A replace loads them into a staged
+    generation, which is thrown away if the load fails. Returns a
+    message, None on failure, and the number of jobs loaded. Raises
+    dump.IdsTaken if kept ids are already in use.
+    """
+    shard = get_shard(aid)
+    db = get_db(shard.database)
+    count = 0
+    generation = None
+    activated = False
+
+    try:
+        if mode == 'replace':
+            generation = write_transaction(db, stage_generation, aid)
+
+        for chunk in chunks:
+            with shard.lock:
+                write_transaction(db, load_jobs, aid, chunk, keep_ids, generation)
+            count += len(chunk)
+
+        if generation is not None:
+            write_transaction(db, activate_generation, aid, generation)
+            activated = True
+            collect_generations(shard.database, aid, generation)
+    except sqlite3.IntegrityError:
+        raise dump.IdsTaken(count)
+    except sqlite3.Error, e:
+        print str(e)
+        return None, count
+    finally:
+        if generation is not None and not activated:
+            discard_generation(shard.database, aid, generation)
+        # the loaded jobs' sessions and expire times are new to this process
+        claimants.clear()
+        shard.expiry.forget()
+        waiters.notify(aid)
+
+    return ("Jobs replaced" if generation is not None else "Jobs imported"), count
+
+@app.route("/export", methods=['POST'])
+@crossdomain(origin='*', headers='Content-Type')
+def export():
+    if hash_password(request.json['password']) != app.config['PASSWORD_HASH']:
+        return make_response("Password invalid", 403)
+    if use_pool():
+        return make_response("Export needs the sqlite engine", 400)
+
+    return Response(export_pool(request.json['administrator_id']),
+                    mimetype='application/x-ndjson')
+
+@app.route("/import", methods=['POST'])
+@crossdomain(origin='*', headers='Content-Type')
+def import_pool():
+    """
+    The body is NDJSON: a header object with the password,
+    administrator_id, mode ('append' or 'replace') and optionally
+    keep_ids, followed by the job lines of a dump.
+    """
+    lines = (line.strip() for line in request.stream)
+    lines = (line for line in lines if line)
+
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        return make_response("Missing header line", 400)
+
+    if hash_password(header['password']) != app.config['PASSWORD_HASH']:
+        return make_response("Password invalid", 403)
+    if use_pool():
+        return make_response("Import needs the sqlite engine", 400)
+
+    mode = header['mode']
+    if mode not in ('append', 'replace'):
+        return make_response("Unknown mode", 400)
+
+    try:
+        message, count = import_chunks(header['administrator_id'], mode,
+            header.get('keep_ids', True),
+            chunked((dump.parse_job(line) for line in lines),
+                    app.config['INGEST_CHUNK_SIZE']))
+    except ValueError:
+        return make_response("Invalid job, earlier chunks were imported", 400)
+    except dump.IdsTaken, e:
+        return make_response("%s, use keep_ids=false" % e, 409)
+
+    if message is None:
+        return make_response("Jobs not imported after %d jobs" % count, 500)
+
+    return "%s (%d jobs)" % (message, count)
+
+
+"""
+Expire jobs
+
+Only touches the database once the scheduler says the earliest
+pending job is due, so polls that claim nothing do no writes
+"""
+
+def expire_due_jobs(c, timestamp):
+    """Returns due jobs to the ready pool. Returns how many expired per
+    administrator_id and the earliest expire time still pending.
+    """
+    c.execute("SELECT administrator_id, COUNT(id) FROM jobs \
+        WHERE status='pending' and expire_time < ? \
+        GROUP BY administrator_id", (timestamp,))
+    expired = c.fetchall()
+
+    if expired:
+        c.execute("UPDATE jobs SET status='ready', rand_key=" + RANDOM_KEY + " \
+            WHERE status='pending' and expire_time < ?",
+            (timestamp,))
+
+    c.execute("SELECT MIN(expire_time) FROM jobs WHERE status='pending'")
+    return expired, c.fetchone()[0]
+
+def expire_jobs(db, shard=None):
+    """Expires the due jobs of shard, by default the main DATABASE."""
+    expiry = (shard or main_shard()).expiry
+    timestamp = epoch_now()
+    if not expiry.due(timestamp):
+        return
+
+    try:
+        expired, next_due = write_transaction(db, expire_due_jobs, timestamp)
+    except Exception,e:
+        print str(e)
+        return
+
+    expiry.reset(next_due, timestamp)
+    # held jobs may have expired, or changed hands in another process
+    claimants.clear()
+    if expired:
+        metrics.inc('administrator_expired_jobs_total',
+                    sum(count for aid, count in expired))
+        waiters.notify()
+
+def expire_jobs_forever(shard):
+    while True:
+        shard.expiry.wait()
+        with app.app_context():
+            expire_jobs(get_db(shard.database), shard)
+
+def start_expiry_thread_for(shard):
+    t = threading.Thread(target=expire_jobs_forever, args=(shard,))
+    t.daemon = True
+    t.start()
+
+@app.before_first_request
+def start_expiry_thread():
+    if app.config['EXPIRY_THREAD'] and not use_pool():
+        start_expiry_thread_for(main_shard())
+
+
+"""
+Archive completed jobs
+
+Moves jobs completed more than ARCHIVE_AGE seconds ago, and each pool's
+completed jobs beyond its newest ARCHIVE_KEEP, out of the jobs table in
+ARCHIVE_BATCH_SIZE batches, then vacuums the freed pages. Either policy
+is off while its setting is None.
+Runs from `manage.py archive`, or every ARCHIVE_INTERVAL seconds from a
+background thread with ARCHIVE_THREAD.
+"""
+
+def archive_completed(age=None, keep=None):
+    """Returns how many jobs were archived. Each shard is archived to
+    a shard of ARCHIVE_DATABASE, since job ids are only unique per file.
+    """
+    if age is None:
+        age = app.config['ARCHIVE_AGE']
+    if keep is None:
+        keep = app.config['ARCHIVE_KEEP']
+
+    archived = 0
+    for key, database in all_databases():
+        archive_database = app.config['ARCHIVE_DATABASE']
+        if archive_database is not None and key is not None:
+            archive_database = shard_path(archive_database, key)
+
+        archived += archiver.archive_jobs(database, archive_database,
+            None if age is None else epoch_now() - age,
+            app.config['ARCHIVE_BATCH_SIZE'],
+            vacuum_pages=app.config['ARCHIVE_VACUUM_PAGES'], keep=keep)
+    return archived
+
+def archive_forever():
+    while True:
+        time.sleep(app.config['ARCHIVE_INTERVAL'])
         try:
-            c.execute("UPDATE jobs SET status='ready'  \
-                WHERE status='pending' and expire_time < ?",
-                (timestamp,))
+            archive_completed()
         except Exception,e:
             print str(e)
 
+@app.before_first_request
+def start_archive_thread():
+    if app.config['ARCHIVE_THREAD']:
+        t = threading.Thread(target=archive_forever)
+        t.daemon = True
+        t.start()
+
+
+"""
+Hand out jobs
+"""
+
+payload_cache = payloads.PayloadCache(app.config['PAYLOAD_CACHE_SIZE'])
+
+def claim_jobs(c, shard, aid, session_name, count):
+    """Claims up to count distinct jobs for session_name and returns
+    them as (job_id, payload) pairs: jobs the session already holds
+    first, then random ready jobs, then random pending ones.
+    """
+    claimed = []
+    generation = active_generation(c, aid)
+
+    # Check if we already have jobs
+    if app.config['TRACK_SESSION']: # hack: only do this if we're tracking sessions
+        claimed = held_jobs(c, aid, generation, session_name)[:count]
+
+    taken = set(job_id for job_id, payload in claimed)
+    new = []
+
+    # get random ready jobs, then pending ones picked by PENDING_POLICY
+    wanted = count - len(claimed)
+    if wanted > 0:
+        new = select_random_jobs(c, aid, generation, 'ready', wanted, taken)
+        taken.update(job_id for job_id, payload, timeout in new)
+
+    wanted = count - len(claimed) - len(new)
+    if wanted > 0:
+        select_pending = PENDING_POLICIES[app.config['PENDING_POLICY']]
+        new.extend(select_pending(c, aid, generation, wanted, taken))
+
+    if new:
+        timestamp = epoch_now()
+        c.executemany("UPDATE jobs SET status='pending', claimant_uuid=?, \
+                        expire_time=? + timeout, claims=claims + 1, \
+                        rand_key=" + RANDOM_KEY + " WHERE id = ?",
+                        [(session_name, timestamp, job_id) for job_id, payload, timeout in new])
+        shard.expiry.schedule(timestamp + min(timeout for job_id, payload, timeout in new))
+
+    # resolved here, where no prune can delete the payloads meanwhile
+    return [(job_id, payload_cache.resolve(c, shard.database, payload))
+            for job_id, payload in claimed + [row[:2] for row in new]]
+
+"""
+Jobs a session holds
+
+The claimant cache says which jobs a session holds, and each of them
+is then checked by primary key. A session the cache does not know is
+looked up through the jobs_claimant index.
+"""
+
+claimants = ClaimantCache(app.config['CLAIMANT_CACHE_SIZE'])
+
+def held_jobs(c, aid, generation, session_name):
+    """Returns the (job_id, payload) pairs session_name holds in aid's
+    active generation.
+    """
+    job_ids = claimants.get(aid, session_name)
+    if job_ids is None:
+        c.execute("SELECT id, COALESCE(json, payload_id) FROM jobs \
+            WHERE administrator_id=? and claimant_uuid=? and status='pending' and generation=?",
+            (aid, session_name, generation))
+        held = [tuple(r) for r in c.fetchall()]
+    elif job_ids:
+        # stay well under SQLite's limit on bound parameters
+        held = []
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            c.execute("SELECT id, COALESCE(json, payload_id) FROM jobs WHERE id IN (%s) \
+                and administrator_id=? and claimant_uuid=? and status='pending' \
+                and generation=?" % ','.join('?' * len(chunk)),
+                chunk + [aid, session_name, generation])
+            held.extend(tuple(r) for r in c.fetchall())
+    else:
+        return []
+
+    if job_ids is None or len(held) != len(job_ids):
+        claimants.set(aid, session_name, [job_id for job_id, payload in held])
+    return held
+
+def claim(aid, count):
+    """Claims jobs for the current session in a single transaction.
+    Raises if the claim could not be committed.
+    """
+    if not 'user_id' in session:
+        session['user_id'] = uuid.uuid4().hex
+
+    session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
+
+    if use_pool():
+        return get_pool().claim(aid, session_name, app.config['TRACK_SESSION'], count)
+
+    shard = get_shard(aid, create=False)
+    if shard is None:
+        return []
+
+    expire_jobs(get_db(shard.database), shard)
+
+    claimed = commit(shard, claim_jobs, shard, aid, session_name, count)
+    claimants.hold(aid, session_name, [job_id for job_id, payload in claimed])
+    return claimed
+
+"""
+Long polling
+
+With a wait in the request, /get and /get_batch park until jobs are
+added or expire instead of answering 503 straight away. Waiters retry
+every WAIT_RECHECK seconds as well, which is how they see jobs added
+through other server processes and jobs whose expiry is due.
+"""
+
+waiters = Waiters()
+
+def json_int(name, default=None):
+    """The request's integer name, default if it is missing or null.
+    Raises ValueError if it is not an integer.
+    """
+    value = request.json.get(name)
+    if value is None:
+        return default
+    try:
+        if isinstance(value, (bool, float)):
+            raise ValueError
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be an integer" % name)
+
+def wait_time():
+    """The seconds the request asked to wait, within WAIT_LIMIT, or None
+    if its wait is not a number.
+    """
+    wait = request.json.get('wait')
+    if wait is None:
+        return 0
+    try:
+        if isinstance(wait, bool):
+            raise ValueError
+        wait = float(wait)
+    except (TypeError, ValueError):
+        return None
+    return max(0, min(wait, app.config['WAIT_LIMIT']))
+
+def claim_waiting(aid, count, wait):
+    """Claims like claim, retrying for up to wait seconds while there
+    is nothing to hand out.
+    """
+    deadline = time.time() + wait
+    while True:
+        version = waiters.version(aid)
+        claimed = claim(aid, count)
+
+        remaining = deadline - time.time()
+        if claimed or remaining <= 0:
+            return claimed
+
+        waiters.wait(aid, version, min(remaining, app.config['WAIT_RECHECK']))
 
 @app.route("/get", methods=['Post'])
 @crossdomain(origin='*', headers='Content-Type')
 def get():
-    if not 'user_id' in session:
-        session['user_id'] = uuid.uuid4().hex
+    aid = request.json['administrator_id']
+    wait = wait_time()
+    if wait is None:
+        return make_response("wait must be a number", 400)
+
+    try:
+        claimed = claim_waiting(aid, 1, wait)
+    except Exception,e:
+        print str(e)
+        return make_response("Job claim failed", 500)
 
+    if not claimed:
+        return make_response("No jobs available", 503)
+
+    job_id, payload = claimed[0]
+    return Response(payloads.job_json(job_id, payloads.decode(payload)),
+                    mimetype='application/json')
+
+@app.route("/get_batch", methods=['Post'])
+@crossdomain(origin='*', headers='Content-Type')
+def get_batch():
     aid = request.json['administrator_id']
+    try:
+        count = json_int('count')
+    except ValueError:
+        count = None
+    if count is None:
+        return make_response("count must be an integer", 400)
+    if count < 1:
+        return make_response("count must be at least 1", 400)
+    count = min(count, app.config['BATCH_LIMIT'])
+    wait = wait_time()
+    if wait is None:
+        return make_response("wait must be a number", 400)
 
-    db = get_db()
-    expire_jobs(db)
-
-    with get_lock:
-        with closing(db.cursor()) as c:
-            try:
-                job_id = None
-                payload = None
-
-                session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
-
-                # Check if we already have a job
-                c.execute("SELECT id, json FROM jobs WHERE administrator_id=? \
-                    and claimant_uuid=? \
-                    and status='pending'", (aid, session_name,))
-
-                c_res = c.fetchone()
-                if not c_res is None and app.config['TRACK_SESSION']: # hack: only do this if we're tracking sessions
-                    job_id, payload = c_res
-                else:
-                    # get a random job
-                    c.execute("SELECT id, json, timeout FROM jobs WHERE administrator_id=? \
-                        and status='ready' ORDER BY RANDOM() LIMIT 1", (aid,))
-
-                    c_res = c.fetchone()
-                    if c_res is None:
-                        # Try to get a pending job
-                        c.execute("SELECT id, json, timeout FROM jobs WHERE administrator_id=? \
-                            and status='pending' ORDER BY RANDOM() LIMIT 1", (aid,))
-                        
-                        c_res = c.fetchone()
-                        if c_res is None:
-                            return make_response("No jobs available", 503)
-
-                    job_id, payload, timeout = c_res
-                    expire_time = datetime.utcnow() + timedelta(seconds=timeout)
-                    
-                    c.execute("UPDATE jobs SET status='pending', claimant_uuid=?, \
-                                expire_time=? WHERE id = ?",
-                                (session_name, expire_time, job_id))
-            except Exception,e:
-                print str(e)
-
-    payload = json.loads(payload)
-    resp = {'job_id': job_id,
-            'payload': payload}
-
-    return jsonify(resp)
+    try:
+        claimed = claim_waiting(aid, count, wait)
+    except Exception,e:
+        print str(e)
+        return make_response("Job claim failed", 500)
+
+    if not claimed:
+        return make_response("No jobs available", 503)
+
+    claimed = [(job_id, payloads.decode(payload)) for job_id, payload in claimed]
+    return Response(payloads.jobs_json(claimed), mimetype='application/json')
 
 @app.route("/confirm", methods=['Post'])
 @crossdomain(origin='*', headers='Content-Type')
@@ -223,21 +1221,241 @@ def confirm():
     aid = request.json['administrator_id']
 
     job_id = request.json['job_id']
+    result = results.result_json(request.json.get('result'))
+    session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
+
+    if not results.is_job_id(job_id):
+        return "Job confirm failed. Job does not exist, was not begun, \
+            already complete, timed out, or belongs to another user"
+
+    if use_pool():
+        if get_pool().confirm(aid, [job_id], session_name, [result])[0] != 'confirmed':
+            return "Job confirm failed. Job does not exist, was not begun, \
+                already complete, timed out, or belongs to another user"
+
+        return "Job confirmed complete"
+
+    shard = get_shard(aid, create=False)
+    if shard is None:
+        return "Job confirm failed. Job does not exist, was not begun, \
+            already complete, timed out, or belongs to another user"
+
+    try:
+        confirmed = commit(shard, confirm_job, aid, job_id, session_name, result)
+    except Exception,e:
+        print str(e)
+        return make_response("Job confirm failed", 500)
+
+    if not confirmed:
+        return "Job confirm failed. Job does not exist, was not begun, \
+            already complete, timed out, or belongs to another user"
+
+    claimants.release(aid, session_name, [job_id])
+    return "Job confirmed complete"
+
+def confirm_job(c, aid, job_id, session_name, result=None):
+    """Completes job_id if session_name holds it, keeping the result
+    JSON text if there is one. Returns whether it did.
+    """
+    timestamp = epoch_now()
+    c.execute("UPDATE jobs SET status='complete', complete_time=? \
+        WHERE administrator_id=? and \
+        id=? and status='pending' and \
+        claimant_uuid=? and generation=?",
+        (timestamp, aid, job_id, session_name, active_generation(c, aid)))
+
+    if c.rowcount != 1:
+        return False
+
+    c.executemany(results.INSERT, results.rows(aid, [(job_id, result)], timestamp,
+                                               app.config['COMPRESS_MIN_SIZE']))
+    return True
+
+"""
+Confirm jobs in bulk
+"""
+
+def held_outcomes(c, aid, session_name, job_ids):
+    """Returns where each of job_ids stands for session_name: held,
+    expired, not_owned, already_complete or not_found.
+    """
+    generation = active_generation(c, aid)
+    found = {}
+    ids = [job_id for job_id in job_ids if results.is_job_id(job_id)]
+
+    # stay well under SQLite's limit on bound parameters
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        c.execute("SELECT id, status, claimant_uuid FROM jobs \
+            WHERE administrator_id=? and generation=? and id IN (%s)" % ', '.join('?' * len(chunk)),
+            [aid, generation] + chunk)
+        found.update((r[0], (r[1], r[2])) for r in c.fetchall())
+
+    outcomes = []
+    for job_id in job_ids:
+        if not results.is_job_id(job_id) or job_id not in found:
+            outcomes.append('not_found')
+            continue
+
+        status, claimant = found[job_id]
+
+        if status == 'complete':
+            outcomes.append('already_complete')
+        elif claimant != session_name:
+            outcomes.append('not_owned')
+        elif status == 'ready':
+            outcomes.append('expired')
+        else:
+            outcomes.append('held')
+
+    return outcomes
+
+def confirm_jobs(c, aid, session_name, job_ids, job_results=None):
+    """Completes the jobs among job_ids that session_name holds, keeping
+    the result JSON texts in job_results for those it completes.
+    Returns each id's outcome: confirmed, expired, not_owned,
+    already_complete or not_found.
+    """
+    job_results = job_results or [None] * len(job_ids)
+    outcomes = []
+    confirmed = set()
+    handed_in = []
+    for job_id, result, outcome in zip(job_ids, job_results,
+                                       held_outcomes(c, aid, session_name, job_ids)):
+        if outcome == 'held' and job_id in confirmed:
+            outcomes.append('already_complete')
+        elif outcome == 'held':
+            outcomes.append('confirmed')
+            confirmed.add(job_id)
+            handed_in.append((job_id, result))
+        else:
+            outcomes.append(outcome)
+
+    timestamp = epoch_now()
+    c.executemany("UPDATE jobs SET status='complete', complete_time=? WHERE id=?",
+                  [(timestamp, job_id) for job_id in confirmed])
+    c.executemany(results.INSERT, results.rows(aid, handed_in, timestamp,
+                                               app.config['COMPRESS_MIN_SIZE']))
+
+    return outcomes
+
+@app.route("/confirm_batch", methods=['Post'])
+@crossdomain(origin='*', headers='Content-Type')
+def confirm_batch():
+    if not 'user_id' in session:
+        session['user_id'] = uuid.uuid4().hex
+
+    aid = request.json['administrator_id']
+
+    job_ids = request.json['job_ids'][:app.config['BATCH_LIMIT']]
+    # results line up with job_ids; missing ones and nulls are no result
+    job_results = request.json.get('results') or []
+    job_results = [results.result_json(result) for result in job_results[:len(job_ids)]]
+    job_results += [None] * (len(job_ids) - len(job_results))
+    session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
+
+    shard = None if use_pool() else get_shard(aid, create=False)
+    if use_pool():
+        outcomes = get_pool().confirm(aid, job_ids, session_name, job_results)
+    elif shard is None:
+        outcomes = ['not_found'] * len(job_ids)
+    else:
+        try:
+            # in a write transaction, so nothing changes hands between
+            # reading the jobs and completing them
+            outcomes = commit(shard, confirm_jobs, aid, session_name, job_ids,
+                              job_results)
+        except Exception,e:
+            print str(e)
+            return make_response("Job confirm failed", 500)
+
+        claimants.release(aid, session_name,
+            [job_id for job_id, outcome in zip(job_ids, outcomes)
+             if outcome == 'confirmed'])
 
-    db = get_db()
+    return jsonify(results=[{'job_id': job_id, 'result': outcome}
+                            for job_id, outcome in zip(job_ids, outcomes)])
+
+"""
+Results
+
+See results.py. With the memory engine the journal is flushed first,
+so every result confirmed so far is in the database.
+"""
+
+@app.route("/results", methods=['POST'])
+@crossdomain(origin='*', headers='Content-Type')
+def get_results():
+    if hash_password(request.json['password']) != app.config['PASSWORD_HASH']:
+        return make_response("Password invalid", 403)
+
+    aid = request.json['administrator_id']
     try:
-        with closing(db.cursor()) as c:
-            session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
+        after = json_int('after', 0)
+        limit = json_int('limit')
+    except ValueError, e:
+        return make_response(str(e), 400)
+    if after < 0 or (limit is not None and limit < 0):
+        return make_response("after and limit must not be negative", 400)
 
-            c.execute("UPDATE jobs SET status='complete' \
-                WHERE administrator_id=? and \
-                id=? and status='pending' and \
-                claimant_uuid=?", (aid, job_id, session_name))
+    if use_pool():
+        get_pool().flush()
+        database = app.config['DATABASE']
+    else:
+        shard = get_shard(aid, create=False)
+        database = app.config['DATABASE'] if shard is None else shard.database
 
-            if c.rowcount != 1:
-                return "Job confirm failed. Job does not exist, was not begun, \
-                    already complete, timed out, or belongs to another user"
-    except:
-        print "Unexpected error confirm"
+    return Response(stream_lines(database, results.result_lines, aid, after,
+                                 limit, app.config['RESULTS_BATCH_SIZE']),
+                    mimetype='application/x-ndjson')
+
+"""
+Heartbeats
+
+A worker still busy with its jobs can extend their leases by another
+timeout each, so that short timeouts catch dead workers quickly without
+long jobs expiring and being handed out again while they run.
+"""
+
+def extend_jobs(c, aid, session_name, job_ids):
+    """Pushes back the expiry of the jobs among job_ids that
+    session_name holds. Returns each id's outcome: extended, expired,
+    not_owned, already_complete or not_found.
+    """
+    outcomes = ['extended' if outcome == 'held' else outcome
+                for outcome in held_outcomes(c, aid, session_name, job_ids)]
+
+    held = [job_id for job_id, outcome in zip(job_ids, outcomes)
+            if outcome == 'extended']
+    for start in range(0, len(held), 500):
+        chunk = held[start:start + 500]
+        c.execute("UPDATE jobs SET expire_time=? + timeout WHERE id IN (%s)"
+                  % ', '.join('?' * len(chunk)), [epoch_now()] + chunk)
+
+    return outcomes
+
+@app.route("/heartbeat", methods=['Post'])
+@crossdomain(origin='*', headers='Content-Type')
+def heartbeat():
+    if not 'user_id' in session:
+        session['user_id'] = uuid.uuid4().hex
+
+    aid = request.json['administrator_id']
+
+    job_ids = request.json['job_ids'][:app.config['BATCH_LIMIT']]
+    session_name = session['user_id'] if app.config['TRACK_SESSION'] else 'FakeSession'
+
+    shard = None if use_pool() else get_shard(aid, create=False)
+    if use_pool():
+        outcomes = get_pool().extend(aid, job_ids, session_name)
+    elif shard is None:
+        outcomes = ['not_found'] * len(job_ids)
+    else:
+        try:
+            outcomes = commit(shard, extend_jobs, aid, session_name, job_ids)
+        except Exception,e:
+            print str(e)
+            return make_response("Heartbeat failed", 500)
 
-    return "Job confirmed complete"
\ No newline at end of file
+    return jsonify(results=[{'job_id': job_id, 'result': outcome}
+                            for job_id, outcome in zip(job_ids, outcomes)])
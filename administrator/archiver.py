@@ -0,0 +1,168 @@
+"""
+Archival of completed jobs
+
+Completed jobs are moved out of the jobs table a batch at a time, each
+batch in its own short transaction, into an archived_jobs table. A job
+is archived once it has been complete for a given age, or once its pool
+has a given number of newer completed jobs, oldest first. That
+table lives either in the main database or in a separate SQLite file
+attached for the purpose. How many jobs each pool has archived is kept
+in archived_counts, so a pool whose jobs were all archived is still not
+empty as far as populate is concerned.
+
+Deduplicated payloads are copied into the archived rows, which then no
+longer depend on the payloads table, and payloads left without jobs
+are pruned.
+
+Freed pages are handed back to the file system with incremental vacuum.
+That only works on databases created with auto_vacuum=INCREMENTAL;
+`manage.py compact` converts an older database with one full VACUUM.
+"""
+
+from collections import defaultdict
+from contextlib import closing
+import payloads
+import sqlite3
+import time
+
+ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS %sarchived_jobs (
+	id INTEGER PRIMARY KEY,
+	administrator_id TEXT,
+	json TEXT,
+	timeout INTEGER,
+	claimant_uuid TEXT,
+	generation INTEGER,
+	complete_time INTEGER
+)"""
+
+# a job loaded from a dump can reuse the id of one already archived;
+# such jobs are left where they are rather than overwrite the archive
+NOT_ARCHIVED = "NOT EXISTS (SELECT 1 FROM %sarchived_jobs a WHERE a.id = jobs.id)"
+
+def connect(database, archive_database=None):
+    """Opens database for archiving. Returns the connection and the
+    prefix of the archived_jobs table.
+    """
+    db = sqlite3.connect(database, isolation_level=None)
+    prefix = ''
+    if archive_database is not None:
+        db.execute("ATTACH DATABASE ? AS archive", (archive_database,))
+        prefix = 'archive.'
+
+    db.execute(ARCHIVE_SCHEMA % prefix)
+    return db, prefix
+
+def archive_rows(db, prefix, rows):
+    """Moves the jobs of (id, administrator_id, generation) rows to the
+    archive, inside the caller's transaction.
+    """
+    ids = [job_id for job_id, aid, generation in rows]
+    marks = ','.join('?' * len(ids))
+    db.execute("INSERT INTO %sarchived_jobs \
+        SELECT id, administrator_id, COALESCE(json, (SELECT json \
+            FROM payloads WHERE payloads.id = jobs.payload_id)), \
+            timeout, claimant_uuid, generation, complete_time \
+        FROM jobs WHERE id IN (%s)" % (prefix, marks), ids)
+
+    counts = defaultdict(int)
+    for job_id, aid, generation in rows:
+        counts[(aid, generation)] += 1
+    db.executemany("INSERT OR IGNORE INTO archived_counts \
+        (administrator_id, generation, count) VALUES (?, ?, 0)",
+        counts.keys())
+    db.executemany("UPDATE archived_counts SET count = count + ? \
+        WHERE administrator_id=? and generation=?",
+        [(n, aid, generation) for (aid, generation), n in counts.items()])
+
+    db.execute("DELETE FROM jobs WHERE id IN (%s)" % marks, ids)
+
+def archive_batch(db, prefix, before, batch_size):
+    """Archives up to batch_size jobs completed before the epoch time
+    before. Returns how many were archived.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute("SELECT id, administrator_id, generation FROM jobs \
+            WHERE status='complete' and complete_time < ? and %s LIMIT ?"
+            % (NOT_ARCHIVED % prefix), (before, batch_size)).fetchall()
+        if rows:
+            archive_rows(db, prefix, rows)
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+    db.execute("COMMIT")
+    return len(rows)
+
+def archive_excess_batch(db, prefix, aid, keep, batch_size):
+    """Archives up to batch_size of aid's oldest completed jobs beyond
+    the newest keep. Returns how many were archived.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        complete = db.execute("SELECT COALESCE(SUM(complete), 0) FROM pool_counts \
+            WHERE administrator_id=?", (aid,)).fetchone()[0]
+        rows = []
+        if complete > keep:
+            rows = db.execute("SELECT id, administrator_id, generation FROM jobs \
+                WHERE administrator_id=? and status='complete' and %s \
+                ORDER BY complete_time, id LIMIT ?" % (NOT_ARCHIVED % prefix),
+                (aid, min(complete - keep, batch_size))).fetchall()
+        if rows:
+            archive_rows(db, prefix, rows)
+    except:
+        db.execute("ROLLBACK")
+        raise
+
+    db.execute("COMMIT")
+    return len(rows)
+
+def archive_jobs(database, archive_database, before, batch_size=500,
+                 pause=0.01, vacuum_pages=None, keep=None):
+    """Archives every job completed before the epoch time before, unless
+    before is None, and every completed job beyond the newest keep of
+    each pool, unless keep is None. Then runs an incremental vacuum of up
+    to vacuum_pages pages (all free pages if None). Returns how many jobs
+    were archived.
+    """
+    archived = 0
+    db, prefix = connect(database, archive_database)
+    with closing(db):
+        while before is not None:
+            count = archive_batch(db, prefix, before, batch_size)
+            archived += count
+            if count < batch_size:
+                break
+            time.sleep(pause)
+
+        if keep is not None:
+            aids = [aid for aid, in db.execute("SELECT administrator_id \
+                FROM pool_counts GROUP BY administrator_id \
+                HAVING SUM(complete) > ?", (keep,)).fetchall()]
+            for aid in aids:
+                while True:
+                    count = archive_excess_batch(db, prefix, aid, keep, batch_size)
+                    archived += count
+                    if count < batch_size:
+                        break
+                    time.sleep(pause)
+
+        held = db.execute("SELECT COUNT(id) FROM jobs WHERE status='complete' \
+            and NOT %s" % (NOT_ARCHIVED % prefix)).fetchone()[0]
+        if held:
+            print "%d completed jobs not archived, their ids are already archived" % held
+
+        payloads.prune(db, batch_size, pause)
+        if vacuum_pages is None:
+            db.execute("PRAGMA incremental_vacuum").fetchall()
+        else:
+            db.execute("PRAGMA incremental_vacuum(%d)" % vacuum_pages).fetchall()
+
+    return archived
+
+def compact(database):
+    """Rewrites database with incremental auto vacuum switched on."""
+    with closing(sqlite3.connect(database, isolation_level=None)) as db:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
@@ -0,0 +1,60 @@
+"""
+Claimant cache
+
+Remembers which jobs each session holds, so that with TRACK_SESSION a
+/get can resume the session's jobs by primary key instead of searching
+for them. Entries are hints: callers re-check each cached job's owner
+and status in the database. That is what keeps them safe when a job
+changes hands in another server process.
+
+A session with no entry is looked up through the jobs_claimant index.
+The cache is cleared whenever expiry runs, so a session whose claims
+went through another process is re-read at least every EXPIRY_RECHECK
+seconds.
+"""
+
+import threading
+
+
+class ClaimantCache(object):
+    def __init__(self, max_entries=100000):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.held = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, aid, claimant):
+        """Returns the ids claimant is known to hold in aid's pool, or
+        None if the cache does not know.
+        """
+        with self.lock:
+            held = self.held.get((aid, claimant))
+            if held is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return list(held)
+
+    def set(self, aid, claimant, job_ids):
+        with self.lock:
+            if len(self.held) >= self.max_entries:
+                self.held = {}
+            self.held[(aid, claimant)] = set(job_ids)
+
+    def hold(self, aid, claimant, job_ids):
+        """Notes that claimant now holds job_ids as well."""
+        with self.lock:
+            held = self.held.get((aid, claimant))
+            if held is not None:
+                held.update(job_ids)
+
+    def release(self, aid, claimant, job_ids):
+        with self.lock:
+            held = self.held.get((aid, claimant))
+            if held is not None:
+                held.difference_update(job_ids)
+
+    def clear(self):
+        with self.lock:
+            self.held = {}
@@ -0,0 +1,57 @@
+"""
+Background garbage collection
+
+Deletes rows a little at a time from a background thread, so that
+dropping a large pool never holds SQLite's write lock for long. The
+deduplicated payloads left without jobs are pruned afterwards.
+"""
+
+from contextlib import closing
+import payloads
+import Queue
+import sqlite3
+import threading
+import time
+
+
+class Collector(threading.Thread):
+    def __init__(self, batch_size=500, pause=0.01):
+        super(Collector, self).__init__()
+        self.daemon = True
+        self.batch_size = batch_size
+        self.pause = pause
+        self.queue = Queue.Queue()
+
+    def collect(self, database, sql, params):
+        """Queues `DELETE FROM jobs WHERE id IN (<sql> LIMIT n)` to be
+        run repeatedly until it deletes nothing. sql selects ids.
+        """
+        self.queue.put((database, sql, params))
+
+    def flush(self):
+        """Blocks until everything queued so far has been collected."""
+        self.queue.join()
+
+    def run(self):
+        while True:
+            database, sql, params = self.queue.get()
+            try:
+                self.delete(database, sql, params)
+            except Exception, e:
+                print str(e)
+            finally:
+                self.queue.task_done()
+
+    def delete(self, database, sql, params):
+        with closing(sqlite3.connect(database, isolation_level=None)) as db:
+            while True:
+                db.execute("BEGIN IMMEDIATE")
+                deleted = db.execute("DELETE FROM jobs WHERE id IN (%s LIMIT ?)" % sql,
+                                     tuple(params) + (self.batch_size,)).rowcount
+                db.execute("COMMIT")
+
+                if deleted < self.batch_size:
+                    payloads.prune(db, self.batch_size, self.pause)
+                    return
+
+                time.sleep(self.pause)
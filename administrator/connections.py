@@ -0,0 +1,134 @@
+"""
+SQLite connection pool
+
+Each thread keeps one open connection per database file and reuses it
+across requests, so requests stop paying for connect and schema
+parsing. New connections get the configured PRAGMAs, which is where
+WAL journaling is switched on.
+
+With many shard files a thread would otherwise end up holding a
+connection, and in WAL mode three file descriptors, for every one of
+them. Given max_open, each thread keeps at most that many, evicting the
+least recently used. An evicted connection may still be in use by the
+request that evicted it, so it is only closed when that request calls
+release. A thread's connections are closed when the thread exits.
+"""
+
+from collections import OrderedDict
+import sqlite3
+import threading
+import weakref
+
+
+def open_connection(database, pragmas):
+    """Opens database in autocommit mode, tuned with pragmas."""
+    db = sqlite3.connect(database, isolation_level=None,
+                         check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    # auto_vacuum only takes effect on an empty database, and setting it
+    # waits for the write lock, so it is left alone on any other
+    empty = db.execute("PRAGMA page_count").fetchone()[0] == 0
+    for name, value in sorted(pragmas.items()):
+        if name != 'auto_vacuum' or empty:
+            db.execute("PRAGMA %s = %s" % (name, value)).fetchall()
+    return db
+
+class ThreadConnections(object):
+    """One thread's connections, by database, least recently used first."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.connections = OrderedDict()
+        self.retired = []
+
+
+class ConnectionPool(object):
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        # every open pooled connection, so close_all can reach other threads'
+        self.connections = set()
+        # the connections opened for each live thread, by a weak reference
+        # to its ThreadConnections, which goes away with the thread
+        self.owners = {}
+        self.generation = 0
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def thread_connections(self):
+        held = getattr(self.local, 'held', None)
+        if held is None or held.generation != self.generation:
+            held = ThreadConnections(self.generation)
+            with self.lock:
+                self.owners[weakref.ref(held, self.thread_gone)] = set()
+            self.local.held = held
+        return held
+
+    def thread_gone(self, ref):
+        """Closes the connections of a thread that has exited."""
+        with self.lock:
+            self.close(self.owners.pop(ref, ()))
+
+    def close(self, dbs):
+        for db in dbs:
+            if db in self.connections:
+                self.connections.remove(db)
+                db.close()
+
+    def connect(self, database, pragmas, max_open=None):
+        """Returns this thread's connection to database, opening it if
+        needed and evicting this thread's least recently used connections
+        beyond max_open.
+        """
+        held = self.thread_connections()
+        db = held.connections.pop(database, None)
+        if db is not None:
+            held.connections[database] = db
+            with self.lock:
+                self.reused += 1
+            return db
+
+        db = open_connection(database, pragmas)
+        held.connections[database] = db
+        with self.lock:
+            self.connections.add(db)
+            self.owners[weakref.ref(held)].add(db)
+            self.opened += 1
+
+        while max_open is not None and len(held.connections) > max_open:
+            held.retired.append(held.connections.popitem(last=False)[1])
+            with self.lock:
+                self.evicted += 1
+
+        return db
+
+    def release(self):
+        """Closes the connections this thread has evicted. Called once
+        the request that may still be using them is over.
+        """
+        held = getattr(self.local, 'held', None)
+        if held is None or not held.retired:
+            return
+
+        retired, held.retired = held.retired, []
+        with self.lock:
+            self.owners.get(weakref.ref(held), set()).difference_update(retired)
+            self.close(retired)
+
+    def close_all(self):
+        """Closes every pooled connection; threads reconnect on next use."""
+        with self.lock:
+            for db in self.connections:
+                db.close()
+            self.connections = set()
+            self.generation += 1
+            for owned in self.owners.values():
+                owned.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'open': len(self.connections),
+                    'opened': self.opened,
+                    'reused': self.reused,
+                    'evicted': self.evicted}
@@ -0,0 +1,85 @@
+"""
+Pool dumps
+
+A dump is NDJSON: a header line naming the administrator_id, then one
+line per job of the pool's active generation in id order, with its
+payload, status and lease (claimant_uuid, expire_time and claims). Jobs
+are read a batch at a time by keyset pagination on id, each batch in a
+read of its own, so a dump of any size takes constant memory and never
+keeps a transaction open for long.
+
+Loading a dump writes a chunk of jobs per transaction. Ids are kept
+unless asked otherwise, so the job ids workers hold stay valid when a
+pool moves to a new instance. Kept ids must not be in use in the
+database, by any pool or generation, so a dump cannot be loaded back
+with its ids into the instance it came from.
+"""
+
+import json
+import payloads
+
+FIELDS = ('timeout', 'status', 'claimant_uuid', 'expire_time', 'claims',
+          'complete_time')
+STATUSES = ('ready', 'pending', 'complete')
+
+
+class IdsTaken(Exception):
+    """Raised when a dump's kept ids are already in use. count is how
+    many jobs were loaded before.
+    """
+
+    def __init__(self, count):
+        Exception.__init__(self, "Job ids already taken after %d jobs" % count)
+        self.count = count
+
+
+def export_lines(db, aid, generation, batch_size=1000):
+    """Yields the dump of aid's jobs in generation, read through db."""
+    yield json.dumps({"administrator_id": aid}) + '\n'
+
+    last = 0
+    while True:
+        rows = db.execute("SELECT jobs.id, COALESCE(jobs.json, payloads.json), \
+            timeout, status, claimant_uuid, expire_time, claims, complete_time \
+            FROM jobs LEFT JOIN payloads ON payloads.id = jobs.payload_id \
+            WHERE administrator_id=? and generation=? and jobs.id > ? \
+            ORDER BY jobs.id LIMIT ?", (aid, generation, last, batch_size)).fetchall()
+
+        for row in rows:
+            yield job_line(row)
+
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0]
+
+def job_line(row):
+    """A job's dump line, built around its payload's JSON text."""
+    row = tuple(row)
+    fields = json.dumps(dict(zip(FIELDS, row[2:])), sort_keys=True)
+    line = u'{"id": %d, "payload": %s, %s}\n' % (row[0], payloads.decode(row[1]),
+                                                 fields[1:-1])
+    return line.encode('utf-8')
+
+def parse_job(line):
+    """Returns the job on a dump line as a dict. Raises ValueError if
+    the line is not a job.
+    """
+    job = json.loads(line)
+    if not isinstance(job, dict) or 'payload' not in job or \
+            not isinstance(job.get('timeout'), (int, long)) or \
+            job.get('status', 'ready') not in STATUSES:
+        raise ValueError("Not a job: %s" % line[:100])
+    return job
+
+def insert_jobs(c, aid, generation, jobs, stored, keep_ids=True):
+    """Inserts parsed jobs into generation of aid's pool. stored holds
+    the (json, payload_id) each job's payload is stored as.
+    """
+    c.executemany("INSERT INTO jobs (id, administrator_id, json, payload_id, \
+        timeout, status, claimant_uuid, expire_time, claims, complete_time, \
+        generation) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(job.get('id') if keep_ids else None, aid, json_text, payload_id,
+          job['timeout'], job.get('status', 'ready'), job.get('claimant_uuid'),
+          job.get('expire_time'), job.get('claims') or 0,
+          job.get('complete_time'), generation)
+         for job, (json_text, payload_id) in zip(jobs, stored)])
@@ -0,0 +1,62 @@
+"""
+Expiry scheduling
+
+Pending jobs return to the ready pool once their expire_time (an
+integer epoch) has passed. Rather than running that UPDATE on every
+request, the scheduler remembers when the earliest pending job is due
+and only reports expiry as due once that time has come.
+
+Claims made by other server processes are invisible to the scheduler,
+so it also reports expiry as due every `recheck` seconds to re-read the
+earliest expire time from the database.
+"""
+
+import threading
+import time
+
+def epoch_now():
+    return int(time.time())
+
+
+class ExpiryScheduler(object):
+    def __init__(self, recheck=5):
+        self.recheck = recheck
+        self.condition = threading.Condition()
+        # None until the database has been asked; inf when nothing is pending
+        self.next_due = None
+        self.checked = 0
+
+    def due(self, now):
+        next_due = self.next_due
+        return next_due is None or next_due < now or \
+            now - self.checked >= self.recheck
+
+    def schedule(self, expire_time):
+        """Notes a newly claimed job's expire time."""
+        with self.condition:
+            if self.next_due is not None and expire_time < self.next_due:
+                self.next_due = expire_time
+                self.condition.notify_all()
+
+    def reset(self, next_due, now):
+        """Records the earliest expire time left after an expiry run."""
+        with self.condition:
+            self.next_due = float('inf') if next_due is None else next_due
+            self.checked = now
+
+    def forget(self):
+        with self.condition:
+            self.next_due = None
+            self.condition.notify_all()
+
+    def wait(self):
+        """Sleeps until expiry is due, for use by a background thread."""
+        with self.condition:
+            while True:
+                now = epoch_now()
+                if self.due(now):
+                    return
+
+                # expire_time < now first holds one second after next_due
+                wake = min(self.next_due + 1, self.checked + self.recheck)
+                self.condition.wait(max(wake - time.time(), 0.01))
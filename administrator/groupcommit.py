@@ -0,0 +1,112 @@
+"""
+Group commit
+
+With GROUP_COMMIT on, claims, confirms and heartbeats are not committed
+by the request threads. Each database has one committer thread that
+runs every write arriving within GROUP_COMMIT_INTERVAL seconds, up to
+GROUP_COMMIT_SIZE of them, in a single transaction. Each write gets its
+own savepoint, so a write that raises is rolled back alone. A request
+waits until the transaction holding its write has committed, so it is
+answered only once the write is as durable as PRAGMA synchronous makes
+any commit. The cost of that sync is shared by the whole batch.
+"""
+
+from connections import open_connection
+from contextlib import closing
+import Queue
+import sqlite3
+import threading
+import time
+
+
+class Write(object):
+    __slots__ = ('f', 'args', 'result', 'error', 'done')
+
+    def __init__(self, f, args):
+        self.f = f
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(threading.Thread):
+    def __init__(self, database, pragmas, interval=0.002, size=100):
+        super(GroupCommitter, self).__init__()
+        self.daemon = True
+        self.database = database
+        self.pragmas = pragmas
+        self.interval = interval
+        self.size = size
+        self.queue = Queue.Queue()
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, f, *args):
+        """Runs f(cursor, *args) in the next batch and returns its result
+        once the batch has committed, or raises what f or the commit raised.
+        """
+        write = Write(f, args)
+        self.queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        with closing(open_connection(self.database, self.pragmas)) as db:
+            while True:
+                batch = self.collect()
+                self.commit(db, [write for write in batch if write is not None])
+                if batch[-1] is None:
+                    return
+
+    def collect(self):
+        """Waits for a write, then gathers whatever else arrives within
+        interval seconds, up to size writes in all.
+        """
+        batch = [self.queue.get()]
+        deadline = time.time() + self.interval
+        while batch[-1] is not None and len(batch) < self.size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
+
+    def commit(self, db, batch):
+        if not batch:
+            return
+
+        with closing(db.cursor()) as c:
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                for write in batch:
+                    c.execute("SAVEPOINT write")
+                    try:
+                        write.result = write.f(c, *write.args)
+                    except Exception, e:
+                        c.execute("ROLLBACK TO write")
+                        write.error = e
+                    c.execute("RELEASE write")
+                c.execute("COMMIT")
+            except Exception, e:
+                try:
+                    c.execute("ROLLBACK")
+                except sqlite3.OperationalError:
+                    pass
+                for write in batch:
+                    write.result = None
+                    write.error = write.error or e
+
+        self.batches += 1
+        self.writes += len(batch)
+        for write in batch:
+            write.done.set()
@@ -0,0 +1,128 @@
+"""
+In-process metrics
+
+Histograms and counters, kept in memory and rendered in the
+Prometheus text format by /metrics along with the gauges it reads at
+scrape time. Nothing here touches the database. Each server process keeps its own figures,
+so Prometheus should scrape every worker or sum across them.
+"""
+
+import threading
+import time
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in labels)
+
+def escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name,
+                format_labels(labels + (('le', repr(float(bound))),)), cumulative))
+        lines.append('%s_bucket%s %d' % (name,
+            format_labels(labels + (('le', '+Inf'),)), self.count))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), self.sum))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), self.count))
+        return lines
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def render(self, gauges=()):
+        """Returns the exposition text. gauges are (name, labels, value)
+        triples read at scrape time, labels being a dict.
+        """
+        samples = {}
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                samples.setdefault(name, []).extend(histogram.render(name, labels))
+            for (name, labels), value in sorted(self.counters.items()):
+                samples.setdefault(name, []).append(
+                    '%s%s %r' % (name, format_labels(labels), value))
+
+        for name, labels, value in sorted(gauges):
+            samples.setdefault(name, []).append('%s%s %r' % (name,
+                format_labels(tuple(sorted(labels.items()))), value))
+
+        lines = []
+        for name in sorted(samples):
+            if name in self.help:
+                kind, text = self.help[name]
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples[name])
+        return '\n'.join(lines) + '\n'
+
+
+class TimedLock(object):
+    """Wraps a lock, recording how long each holder waited for it and
+    then held it.
+    """
+
+    def __init__(self, lock, metrics, name):
+        self.lock = lock
+        self.metrics = metrics
+        self.name = name
+        self.acquired = None
+
+    def __enter__(self):
+        start = time.time()
+        self.lock.acquire()
+        self.acquired = time.time()
+        self.metrics.observe('administrator_lock_wait_seconds',
+                             self.acquired - start, lock=self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.time() - self.acquired
+        self.lock.release()
+        self.metrics.observe('administrator_lock_held_seconds', held, lock=self.name)
+
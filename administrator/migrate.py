@@ -0,0 +1,84 @@
+"""
+Schema migration
+
+A jobs table from an older version of the schema is rebuilt rather
+than altered, since columns such as rand_key have defaults that ALTER
+TABLE ADD COLUMN cannot add. The old table is renamed to jobs_old and
+stripped of its indexes and triggers, the schema creates the current
+jobs table, and the rows are copied over, ids and all, in one
+transaction. Columns the old table lacks take their defaults. TIMESTAMP
+strings in expire_time become epoch integers, as SQLite orders any TEXT
+value after every INTEGER and such jobs would never expire. Completed
+jobs without a complete_time are stamped with the time of the
+migration. Each step can be run again, so a migration that was cut
+short finishes the next time the tables are created.
+"""
+
+from contextlib import closing
+import sqlite3
+
+def columns(db, table):
+    return [row[1] for row in db.execute("PRAGMA table_info(%s)" % table)]
+
+def outdated(db, schema):
+    """Whether db has a jobs table without every column schema gives it."""
+    present = columns(db, 'jobs')
+    if not present:
+        return False
+
+    with closing(sqlite3.connect(':memory:')) as fresh:
+        fresh.executescript(schema)
+        return not set(columns(fresh, 'jobs')) <= set(present)
+
+def set_aside(db, schema):
+    """Renames an outdated jobs table to jobs_old and drops the indexes
+    and triggers that went with it, so that the schema creates them for
+    the new table. Checks again under the write lock, as another process
+    may be migrating the same database.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        if outdated(db, schema) and not columns(db, 'jobs_old'):
+            db.execute("ALTER TABLE jobs RENAME TO jobs_old")
+            for kind, name in db.execute("SELECT type, name FROM sqlite_master \
+                    WHERE tbl_name='jobs_old' and type IN ('index', 'trigger') \
+                    and sql IS NOT NULL").fetchall():
+                db.execute("DROP %s %s" % (kind.upper(), name))
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def copy_jobs(db, timestamp):
+    """Moves the rows of jobs_old, if there is one, into jobs."""
+    if not columns(db, 'jobs_old'):
+        return
+
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        old = columns(db, 'jobs_old')
+        if old:
+            copy_rows(db, old, timestamp)
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def copy_rows(db, old, timestamp):
+    names = [name for name in old if name in columns(db, 'jobs')]
+    values = list(names)
+    if 'expire_time' in names:
+        values[names.index('expire_time')] = "CASE WHEN typeof(expire_time)='text' \
+            THEN CAST(strftime('%s', expire_time) AS INTEGER) ELSE expire_time END"
+    if 'complete_time' not in names:
+        names.append('complete_time')
+        values.append("CASE WHEN status='complete' THEN %d END" % timestamp)
+
+    # the pool_counts triggers count the rows again as they go in
+    db.execute("DELETE FROM pool_counts")
+    db.execute("INSERT INTO jobs (%s) SELECT %s FROM jobs_old"
+               % (', '.join(names), ', '.join(values)))
+    # ids handed out before, even of jobs since deleted, stay used
+    db.execute("DELETE FROM sqlite_sequence WHERE name='jobs'")
+    db.execute("UPDATE sqlite_sequence SET name='jobs' WHERE name='jobs_old'")
+    db.execute("DROP TABLE jobs_old")
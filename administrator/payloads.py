@@ -0,0 +1,135 @@
+"""
+Stored job payloads
+
+A payload is kept as the JSON text it was added with and handed back
+out by splicing that text into the response, so the server never parses
+a payload after /add. Payloads of at least COMPRESS_MIN_SIZE bytes are
+stored zlib-compressed as BLOBs. TEXT rows are read back unchanged, so
+compressed and plain rows can sit side by side in the jobs table.
+
+With DEDUP_PAYLOADS, /add stores each distinct payload once in the
+payloads table, found again by the SHA-1 of its text, and the job rows
+only hold its payload_id. Claims read the job's payload as
+COALESCE(json, payload_id), so a deduplicated one comes back as an
+integer and is resolved through a PayloadCache. Payload ids come from
+AUTOINCREMENT and are never reused, so cached payloads cannot go stale.
+Payloads no job refers to any more are pruned after jobs are collected
+or archived.
+"""
+
+from collections import OrderedDict
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+def encode(payload, min_size=None):
+    """Returns payload as it should be stored in the json column."""
+    if min_size is None or len(payload) < min_size:
+        return payload
+
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return sqlite3.Binary(zlib.compress(payload))
+
+def decode(stored):
+    """Returns the JSON text of a stored payload."""
+    if isinstance(stored, buffer):
+        stored = zlib.decompress(stored)
+    if isinstance(stored, str):
+        return stored.decode('utf-8')
+    return stored
+
+def job_json(job_id, payload):
+    """The body /get returns, built around the payload's JSON text."""
+    return '{"job_id": %d, "payload": %s}' % (job_id, payload)
+
+def jobs_json(claimed):
+    return '[%s]' % ', '.join(job_json(job_id, payload)
+                              for job_id, payload in claimed)
+
+def digest(payload):
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()
+
+def store(c, chunk, min_size=None):
+    """Stores the payloads of chunk in the payloads table, each distinct
+    one once. Returns their payload ids, in the order of chunk.
+    """
+    ids = {}
+    for payload in chunk:
+        if payload in ids:
+            continue
+
+        payload_hash = digest(payload)
+        c.execute("INSERT OR IGNORE INTO payloads (hash, json) VALUES (?, ?)",
+                  (payload_hash, encode(payload, min_size)))
+        if c.rowcount == 1:
+            ids[payload] = c.lastrowid
+        else:
+            c.execute("SELECT id FROM payloads WHERE hash=?", (payload_hash,))
+            ids[payload] = c.fetchone()[0]
+
+    return [ids[payload] for payload in chunk]
+
+def prune(db, batch_size=500, pause=0.01):
+    """Deletes payloads no job refers to, batch_size per transaction.
+    db must be in autocommit mode. Returns how many were deleted.
+    """
+    pruned = 0
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        deleted = db.execute("DELETE FROM payloads WHERE id IN (SELECT id \
+            FROM payloads WHERE NOT EXISTS (SELECT 1 FROM jobs \
+            WHERE jobs.payload_id = payloads.id) LIMIT ?)", (batch_size,)).rowcount
+        db.execute("COMMIT")
+
+        pruned += deleted
+        if deleted < batch_size:
+            return pruned
+
+        time.sleep(pause)
+
+
+class PayloadCache(object):
+    """The JSON text of recently handed out deduplicated payloads, least
+    recently used first out.
+    """
+
+    def __init__(self, max_entries=1000):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.texts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, c, database, stored):
+        """Returns stored as read from a job row: the payload it refers
+        to if it is a payload id, looked up through c on a miss.
+        """
+        if not isinstance(stored, (int, long)):
+            return stored
+
+        key = (database, stored)
+        with self.lock:
+            text = self.texts.pop(key, None)
+            if text is not None:
+                self.hits += 1
+                self.texts[key] = text
+                return text
+            self.misses += 1
+
+        c.execute("SELECT json FROM payloads WHERE id=?", (stored,))
+        text = decode(c.fetchone()[0])
+
+        with self.lock:
+            self.texts[key] = text
+            if len(self.texts) > self.max_entries:
+                self.texts.popitem(last=False)
+        return text
+
+    def clear(self):
+        with self.lock:
+            self.texts.clear()
@@ -0,0 +1,549 @@
+"""
+In-memory job pool engine
+
+Keeps the ready and pending jobs of every administrator_id in memory so
+that /add, /get and /confirm never wait on the disk. SQLite is only a
+write-behind journal: every mutation is queued and committed in batches
+by a background thread, and the pool is rebuilt from the database when
+the engine starts.
+
+Each server process holds its own copy of the pool, so this engine must
+only be used with a single worker process.
+"""
+
+from contextlib import closing
+from expiry import epoch_now
+import payloads
+import results
+import heapq
+import Queue
+import random
+import sqlite3
+import threading
+
+
+class RandomSet(object):
+    """Array-backed set with O(1) add, remove and random choice."""
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def add(self, item):
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        pos = self.positions.pop(item, None)
+        if pos is None:
+            return
+
+        # fill the hole with the last item
+        last = self.items.pop()
+        if pos < len(self.items):
+            self.items[pos] = last
+            self.positions[last] = pos
+
+    def choice(self):
+        return self.items[random.randrange(len(self.items))]
+
+
+class Job(object):
+    __slots__ = ('id', 'json', 'timeout', 'status', 'claimant', 'expire_time',
+                 'claims')
+
+    def __init__(self, id, json, timeout, status='ready',
+                 claimant=None, expire_time=None, claims=0):
+        self.id = id
+        self.json = json
+        self.timeout = timeout
+        self.status = status
+        self.claimant = claimant
+        self.expire_time = expire_time
+        # times the job has been handed out
+        self.claims = claims
+
+
+class Pool(object):
+    """Live (ready or pending) jobs of a single administrator_id."""
+
+    def __init__(self, generation=0):
+        self.generation = generation
+        self.jobs = {}
+        self.ready = RandomSet()
+        self.pending = RandomSet()
+        # min-heap of (expire_time, job_id); entries are dropped lazily
+        # once the job has been confirmed or re-claimed
+        self.expiries = []
+        # min-heap of (claims, expire_time, job_id) over pending jobs,
+        # built on first use by least_claimed and dropped from lazily
+        self.by_claims = None
+        # claimant -> ids of the pending jobs it holds
+        self.claims = {}
+        # ids of completed jobs, which are otherwise dropped from memory
+        self.completed = set()
+        # rows in the database for this pool, including completed ones
+        self.size = 0
+
+    def insert(self, job):
+        status, job.status = job.status, 'ready'
+        self.jobs[job.id] = job
+        self.ready.add(job.id)
+        if status == 'pending':
+            self.take(job, job.claimant, job.expire_time)
+
+    def take(self, job, claimant, expire_time):
+        """Hands a ready or pending job to claimant."""
+        self.release(job)
+        job.status = 'pending'
+        job.claimant = claimant
+        job.expire_time = expire_time
+        self.ready.discard(job.id)
+        self.pending.add(job.id)
+        self.claims.setdefault(claimant, set()).add(job.id)
+        heapq.heappush(self.expiries, (expire_time, job.id))
+        if self.by_claims is not None:
+            heapq.heappush(self.by_claims, (job.claims, expire_time, job.id))
+
+    def extend(self, job, expire_time):
+        """Pushes back a pending job's expiry."""
+        job.expire_time = expire_time
+        heapq.heappush(self.expiries, (expire_time, job.id))
+        if self.by_claims is not None:
+            heapq.heappush(self.by_claims, (job.claims, expire_time, job.id))
+
+    def release(self, job):
+        """Returns a pending job to the ready pool."""
+        if job.status == 'pending':
+            held = self.claims.get(job.claimant)
+            held.discard(job.id)
+            if not held:
+                del self.claims[job.claimant]
+
+            job.status = 'ready'
+            self.pending.discard(job.id)
+            self.ready.add(job.id)
+
+    def complete(self, job):
+        self.release(job)
+        self.ready.discard(job.id)
+        del self.jobs[job.id]
+        self.completed.add(job.id)
+
+    def random_pending(self, count, exclude):
+        """Returns up to count random pending jobs not in exclude."""
+        candidates = random.sample(self.pending.items,
+            min(count + len(exclude), len(self.pending)))
+        return [self.jobs[job_id] for job_id in candidates
+                if job_id not in exclude][:count]
+
+    def least_claimed(self, count, exclude):
+        """Returns up to count pending jobs not in exclude, those handed
+        out the fewest times first and, among them, those closest to
+        expiring. The jobs returned leave the heap until they are taken.
+        """
+        if self.by_claims is None:
+            self.by_claims = [(self.jobs[job_id].claims, self.jobs[job_id].expire_time,
+                               job_id) for job_id in self.pending.items]
+            heapq.heapify(self.by_claims)
+
+        jobs = []
+        skipped = []
+        while self.by_claims and len(jobs) < count:
+            entry = heapq.heappop(self.by_claims)
+            claims, expire_time, job_id = entry
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'pending' or \
+                    (job.claims, job.expire_time) != (claims, expire_time):
+                continue
+
+            if job_id in exclude:
+                skipped.append(entry)
+            else:
+                jobs.append(job)
+
+        for entry in skipped:
+            heapq.heappush(self.by_claims, entry)
+        return jobs
+
+    def claimed_by(self, claimant):
+        return [self.jobs[job_id] for job_id in self.claims.get(claimant, ())]
+
+    def expire(self, now):
+        """Returns the ids of the pending jobs that have timed out."""
+        expired = []
+        while self.expiries and self.expiries[0][0] < now:
+            expire_time, job_id = heapq.heappop(self.expiries)
+            job = self.jobs.get(job_id)
+            if job is None or job.status != 'pending' or job.expire_time != expire_time:
+                continue
+
+            self.release(job)
+            expired.append(job_id)
+
+        return expired
+
+
+# how JobPool.claim picks pending jobs once no ready ones are left
+PENDING_POLICIES = {'random': Pool.random_pending,
+                    'least_claimed': Pool.least_claimed}
+
+
+class Journal(threading.Thread):
+    """Commits queued statements to SQLite in the background."""
+
+    def __init__(self, database, batch_size=1000):
+        super(Journal, self).__init__()
+        self.daemon = True
+        self.database = database
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+
+    def write(self, sql, params=()):
+        self.queue.put((sql, params, False))
+
+    def write_many(self, sql, seq_of_params):
+        self.queue.put((sql, seq_of_params, True))
+
+    def flush(self):
+        """Blocks until everything written so far is committed."""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        with closing(sqlite3.connect(self.database, isolation_level=None)) as db:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < self.batch_size and batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                self.commit(db, [entry for entry in batch if entry is not None])
+
+                for entry in batch:
+                    self.queue.task_done()
+
+                if batch[-1] is None:
+                    return
+
+    def commit(self, db, batch):
+        try:
+            db.execute("BEGIN")
+            for entry in batch:
+                self.apply(db, *entry)
+            db.execute("COMMIT")
+        except Exception, e:
+            print str(e)
+            db.execute("ROLLBACK")
+            # apply one at a time so a bad statement only loses itself
+            for entry in batch:
+                try:
+                    self.apply(db, *entry)
+                except Exception, e:
+                    print str(e)
+
+    def apply(self, db, sql, params, many):
+        if many:
+            db.executemany(sql, params)
+        else:
+            db.execute(sql, params)
+
+
+class JobPool(object):
+    """The in-memory engine: every pool, plus the journal behind them."""
+
+    def __init__(self, database, compress_min_size=None, waiters=None,
+                 pending_policy='random'):
+        self.lock = threading.Lock()
+        self.compress_min_size = compress_min_size
+        self.select_pending = PENDING_POLICIES[pending_policy]
+        # woken whenever jobs are added
+        self.waiters = waiters
+        self.pools = {}
+        # newest generation reserved for each administrator_id
+        self.latest = {}
+        self.next_id = 1
+        # jobs returned to their pools by expiry since the pool was loaded
+        self.expired = 0
+        self.load(database)
+        self.journal = Journal(database)
+        self.journal.start()
+
+    def load(self, database):
+        """Rebuilds the pools from the database."""
+        with closing(sqlite3.connect(database)) as db:
+            for aid, active, latest in db.execute("SELECT administrator_id, \
+                    active, latest FROM generations"):
+                self.pools[aid] = Pool(active)
+                self.latest[aid] = latest
+
+            # rows of inactive generations are waiting to be deleted;
+            # archived jobs still count towards a pool's size
+            for aid, generation, size in db.execute("SELECT administrator_id, \
+                    generation, COUNT(id) FROM jobs \
+                    GROUP BY administrator_id, generation \
+                    UNION ALL SELECT administrator_id, generation, count \
+                    FROM archived_counts"):
+                if generation == self.pool(aid).generation:
+                    self.pool(aid).size += size
+
+            # AUTOINCREMENT remembers ids that have since been archived
+            max_id = db.execute("SELECT MAX(seq) FROM (SELECT MAX(id) AS seq \
+                FROM jobs UNION ALL SELECT seq FROM sqlite_sequence \
+                WHERE name='jobs')").fetchone()[0]
+            self.next_id = (max_id or 0) + 1
+
+            # jobs sharing a deduplicated payload share its text
+            shared = {}
+            for row in db.execute("SELECT jobs.id, administrator_id, generation, \
+                    jobs.payload_id, COALESCE(jobs.json, payloads.json), timeout, \
+                    status, claimant_uuid, expire_time, claims FROM jobs \
+                    LEFT JOIN payloads ON payloads.id = jobs.payload_id \
+                    WHERE status IN ('ready', 'pending')"):
+                job_id, aid, generation, payload_id, payload, timeout, status, \
+                    claimant, expire_time, claims = row
+                if generation != self.pool(aid).generation:
+                    continue
+
+                if payload_id is None:
+                    payload = payloads.decode(payload)
+                elif payload_id in shared:
+                    payload = shared[payload_id]
+                else:
+                    payload = shared[payload_id] = payloads.decode(payload)
+                self.pool(aid).insert(Job(job_id, payload, timeout, status,
+                                          claimant, expire_time, claims))
+
+            for job_id, aid, generation in db.execute("SELECT id, administrator_id, \
+                    generation FROM jobs WHERE status='complete'"):
+                if generation == self.pool(aid).generation:
+                    self.pool(aid).completed.add(job_id)
+
+    def pool(self, aid):
+        if aid not in self.pools:
+            self.pools[aid] = Pool()
+        return self.pools[aid]
+
+    def close(self):
+        self.journal.close()
+
+    def flush(self):
+        """Blocks until every change so far is in the database."""
+        self.journal.flush()
+
+    def add_chunks(self, aid, mode, timeout, chunks):
+        """Adds jobs a chunk of payloads at a time, like add_chunks for
+        the sqlite engine. A replace fills a detached pool that is only
+        swapped in once every chunk is in.
+        """
+        staged = self.stage(aid) if mode == 'replace' else None
+        message = None
+        count = 0
+
+        for chunk in chunks:
+            with self.lock:
+                pool = staged or self.pool(aid)
+                if mode == 'populate' and pool.size != 0:
+                    return "Not repopulating jobs", count
+
+                self.insert(aid, pool, chunk, timeout)
+
+            if not staged:
+                self.notify(aid)
+            message = message or ("Jobs replaced" if staged else "Jobs appended")
+            count += len(chunk)
+            if mode == 'populate':
+                mode = 'append'
+
+        if staged is not None:
+            self.activate(aid, staged)
+            self.notify(aid)
+
+        return message, count
+
+    def stats(self, aid=None):
+        """Returns the ready, pending and complete counts of aid's pool,
+        or of every pool.
+        """
+        with self.lock:
+            if aid is None:
+                pools = self.pools.items()
+            else:
+                pools = [(aid, self.pools[aid])] if aid in self.pools else []
+            return [(pool_aid, {'ready': len(pool.ready),
+                                'pending': len(pool.pending),
+                                'complete': len(pool.completed)})
+                    for pool_aid, pool in pools]
+
+    def notify(self, aid):
+        if self.waiters is not None:
+            self.waiters.notify(aid)
+
+    def insert(self, aid, pool, chunk, timeout):
+        rows = []
+        for payload in chunk:
+            job = Job(self.next_id, payload, timeout)
+            self.next_id += 1
+            pool.insert(job)
+            rows.append((job.id, aid,
+                         payloads.encode(payload, self.compress_min_size),
+                         timeout, pool.generation))
+
+        pool.size += len(rows)
+        self.journal.write_many("INSERT INTO jobs \
+            (id, administrator_id, json, timeout, status, generation) \
+            VALUES (?, ?, ?, ?, 'ready', ?)", rows)
+
+    def stage(self, aid):
+        """Returns an empty pool for a new generation of aid's jobs."""
+        with self.lock:
+            generation = self.latest[aid] = self.latest.get(aid, 0) + 1
+            self.journal.write("INSERT OR IGNORE INTO generations \
+                (administrator_id, active, latest) VALUES (?, 0, 0)", (aid,))
+            self.journal.write("UPDATE generations SET latest=? \
+                WHERE administrator_id=?", (generation, aid))
+
+            return Pool(generation)
+
+    def activate(self, aid, staged):
+        with self.lock:
+            if staged.generation < self.pool(aid).generation:
+                return
+
+            self.pools[aid] = staged
+            self.journal.write("UPDATE generations SET active=? \
+                WHERE administrator_id=?", (staged.generation, aid))
+            self.journal.write("DELETE FROM jobs WHERE administrator_id=? \
+                and generation < ?", (aid, staged.generation))
+
+    def claim(self, aid, claimant, track_session, count=1):
+        """Hands out up to count distinct jobs as (job_id, payload) pairs,
+        with the same preference order as the sqlite engine.
+        """
+        with self.lock:
+            pool = self.pools.get(aid)
+            if pool is None:
+                return []
+
+            now = epoch_now()
+            expired = pool.expire(now)
+            self.expired += len(expired)
+            if expired:
+                self.journal.write_many("UPDATE jobs SET status='ready' \
+                    WHERE id=? and status='pending'", [(i,) for i in expired])
+
+            claimed = pool.claimed_by(claimant)[:count] if track_session else []
+            taken = set(job.id for job in claimed)
+            new = []
+
+            while len(claimed) + len(new) < count and pool.ready:
+                job = pool.jobs[pool.ready.choice()]
+                job.claims += 1
+                pool.take(job, claimant, now + job.timeout)
+                new.append(job)
+
+            wanted = count - len(claimed) - len(new)
+            if wanted > 0 and pool.pending:
+                taken.update(job.id for job in new)
+                fallback = self.select_pending(pool, wanted, taken)
+
+                for job in fallback:
+                    job.claims += 1
+                    pool.take(job, claimant, now + job.timeout)
+                new.extend(fallback)
+
+            if new:
+                self.journal.write_many("UPDATE jobs SET status='pending', \
+                    claimant_uuid=?, expire_time=?, claims=? WHERE id=?",
+                    [(claimant, job.expire_time, job.claims, job.id) for job in new])
+
+            return [(job.id, job.json) for job in claimed + new]
+
+    def confirm(self, aid, job_ids, claimant, job_results=None):
+        """Completes the jobs among job_ids that claimant holds, keeping
+        the result JSON texts in job_results for those it completes.
+        Returns each id's outcome, as confirm_jobs does for the sqlite
+        engine.
+        """
+        job_results = job_results or [None] * len(job_ids)
+        with self.lock:
+            pool = self.pools.get(aid) or Pool()
+            outcomes = []
+            confirmed = []
+            handed_in = []
+            now = epoch_now()
+            for job_id, result in zip(job_ids, job_results):
+                if not results.is_job_id(job_id):
+                    outcomes.append('not_found')
+                    continue
+
+                job = pool.jobs.get(job_id)
+                if job_id in pool.completed:
+                    outcomes.append('already_complete')
+                elif job is None:
+                    outcomes.append('not_found')
+                elif job.claimant != claimant:
+                    outcomes.append('not_owned')
+                elif job.status == 'ready':
+                    outcomes.append('expired')
+                else:
+                    outcomes.append('confirmed')
+                    pool.complete(job)
+                    confirmed.append((now, job_id))
+                    handed_in.append((job_id, result))
+
+            if confirmed:
+                self.journal.write_many("UPDATE jobs SET status='complete', \
+                    complete_time=? WHERE id=?", confirmed)
+                result_rows = results.rows(aid, handed_in, now, self.compress_min_size)
+                if result_rows:
+                    self.journal.write_many(results.INSERT, result_rows)
+
+            return outcomes
+
+    def extend(self, aid, job_ids, claimant):
+        """Pushes back the expiry of the jobs among job_ids that claimant
+        holds. Returns each id's outcome, as extend_jobs does for the
+        sqlite engine.
+        """
+        with self.lock:
+            pool = self.pools.get(aid) or Pool()
+            outcomes = []
+            extended = []
+            now = epoch_now()
+            for job_id in job_ids:
+                if not results.is_job_id(job_id):
+                    outcomes.append('not_found')
+                    continue
+
+                job = pool.jobs.get(job_id)
+                if job_id in pool.completed:
+                    outcomes.append('already_complete')
+                elif job is None:
+                    outcomes.append('not_found')
+                elif job.claimant != claimant:
+                    outcomes.append('not_owned')
+                elif job.status == 'ready':
+                    outcomes.append('expired')
+                else:
+                    outcomes.append('extended')
+                    pool.extend(job, now + job.timeout)
+                    extended.append((job.expire_time, job_id))
+
+            if extended:
+                self.journal.write_many("UPDATE jobs SET expire_time=? WHERE id=?",
+                                        extended)
+
+            return outcomes
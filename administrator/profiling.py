@@ -0,0 +1,171 @@
+"""
+Request profiling
+
+With PROFILE set, or for a request whose X-Administrator-Profile header
+holds the password, the request runs under cProfile and each SQL
+statement it executes is timed. Profiles are added up per endpoint and
+written to PROFILE_DIR as <endpoint>.prof, for pstats or snakeviz, and
+the statement timings as <endpoint>.sql.json. The files are written from
+the totals kept in memory, every PROFILE_WRITE_INTERVAL seconds and at
+exit, never by the profiled requests themselves. A profiled response
+also carries its own statement timings in a Server-Timing header.
+
+Requests that are not profiled use the plain connections and cursors,
+so they only pay for checking whether to profile.
+"""
+
+from collections import OrderedDict
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+def statement(sql):
+    """sql with its whitespace collapsed, to name it by."""
+    return ' '.join(sql.split())
+
+
+class Spans(object):
+    """The time one request spent in each SQL statement."""
+
+    def __init__(self):
+        self.spans = OrderedDict()
+
+    def add(self, sql, seconds):
+        span = self.spans.get(sql)
+        if span is None:
+            span = self.spans[sql] = [0, 0.0]
+        span[0] += 1
+        span[1] += seconds
+
+    def server_timing(self, limit=20, width=60):
+        """The slowest statements, as a Server-Timing header value."""
+        spans = sorted(self.spans.items(), key=lambda (sql, span): -span[1])
+        return ', '.join('sql%d;desc="%s";dur=%.3f' % (
+                         i, statement(sql)[:width].replace('"', "'"), 1000 * seconds)
+                         for i, (sql, (count, seconds)) in enumerate(spans[:limit]))
+
+
+class TracedCursor(object):
+    """A cursor that adds the time of each statement, and of fetching
+    its rows, to spans.
+    """
+
+    def __init__(self, cursor, spans):
+        self.cursor = cursor
+        self.spans = spans
+        self.sql = None
+
+    def timed(self, f, *args):
+        start = time.time()
+        try:
+            return f(*args)
+        finally:
+            self.spans.add(self.sql, time.time() - start)
+
+    def execute(self, sql, params=()):
+        self.sql = sql
+        self.timed(self.cursor.execute, sql, params)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self.sql = sql
+        self.timed(self.cursor.executemany, sql, seq_of_params)
+        return self
+
+    def fetchone(self):
+        return self.timed(self.cursor.fetchone)
+
+    def fetchall(self):
+        return self.timed(self.cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TracedConnection(object):
+    def __init__(self, db, spans):
+        self.db = db
+        self.spans = spans
+
+    def cursor(self):
+        return TracedCursor(self.db.cursor(), self.spans)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class Profiler(object):
+    """Adds up the profiles and statement timings of each endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.sql = {}
+        self.requests = {}
+        # endpoints profiled since their files were last written
+        self.dirty = set()
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile, Spans()
+
+    def finish(self, endpoint, profile, spans):
+        """Adds a finished request's profile and spans to endpoint's."""
+        profile.disable()
+        request_stats = pstats.Stats(profile)
+        with self.lock:
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                self.stats[endpoint] = request_stats
+            else:
+                stats.add(request_stats)
+
+            totals = self.sql.setdefault(endpoint, {})
+            for sql, (count, seconds) in spans.spans.items():
+                total = totals.setdefault(statement(sql), [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.dirty.add(endpoint)
+
+    def write(self, directory):
+        """Rewrites the files in directory of each endpoint profiled
+        since the last write.
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            for endpoint in self.dirty:
+                path = os.path.join(directory, endpoint)
+                self.stats[endpoint].dump_stats(path + '.prof')
+                with open(path + '.sql.json', 'w') as f:
+                    json.dump({"requests": self.requests[endpoint],
+                               "statements": [{"sql": sql, "count": count, "seconds": seconds}
+                                              for sql, (count, seconds) in sorted(
+                                                  self.sql[endpoint].items(),
+                                                  key=lambda (sql, total): -total[1])]},
+                              f, indent=1)
+            self.dirty = set()
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+            self.sql = {}
+            self.requests = {}
+            self.dirty = set()
@@ -0,0 +1,59 @@
+"""
+Job results
+
+A worker can hand in a result with each job it confirms. Results are
+kept as JSON text in a results table, written in the same transaction
+that completes the job, and compressed like payloads from
+COMPRESS_MIN_SIZE bytes. Each result is numbered in the order it came
+in, so a consumer drains a pool's results by asking for those after the
+last id it saw. They are streamed as NDJSON a page at a time by keyset
+pagination on that id, never with OFFSET and never all in memory.
+"""
+
+import json
+import payloads
+
+INSERT = "INSERT INTO results (administrator_id, job_id, json, complete_time) \
+    VALUES (?, ?, ?, ?)"
+
+def is_job_id(value):
+    """Whether value, as a worker sent it, can be a job id. Only JSON
+    integers can; 1.5 and true would otherwise be taken for job 1.
+    """
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+def result_json(result):
+    """The JSON text stored for a result, or None if there is none."""
+    return None if result is None else json.dumps(result)
+
+def rows(aid, job_results, complete_time, min_size=None):
+    """The insert parameters for (job_id, result JSON text) pairs."""
+    return [(aid, int(job_id), payloads.encode(text, min_size), complete_time)
+            for job_id, text in job_results if text is not None]
+
+def result_lines(db, aid, after=0, limit=None, batch_size=1000):
+    """Yields aid's results numbered after after, oldest first, at most
+    limit of them, read through db.
+    """
+    remaining = limit
+    while remaining is None or remaining > 0:
+        page = batch_size if remaining is None else min(batch_size, remaining)
+        page_rows = db.execute("SELECT id, job_id, complete_time, json FROM results \
+            WHERE administrator_id=? and id > ? ORDER BY id LIMIT ?",
+            (aid, after, page)).fetchall()
+
+        for row in page_rows:
+            yield result_line(row)
+
+        if len(page_rows) < page:
+            return
+        after = page_rows[-1][0]
+        if remaining is not None:
+            remaining -= len(page_rows)
+
+def result_line(row):
+    """A result's line, built around its JSON text."""
+    result_id, job_id, complete_time, stored = tuple(row)
+    line = u'{"id": %d, "job_id": %d, "complete_time": %d, "result": %s}\n' % (
+        result_id, job_id, complete_time, payloads.decode(stored))
+    return line.encode('utf-8')
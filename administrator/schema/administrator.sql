@@ -10,6 +10,127 @@ CREATE TABLE IF NOT EXISTS jobs (
     timeout INTEGER,
     status TEXT,
     claimant_uuid TEXT,
-    expire_time TIMESTAMP,
+    expire_time INTEGER,
+    rand_key REAL DEFAULT (random() / 18446744073709551616.0 + 0.5),
+    generation INTEGER DEFAULT 0,
+    complete_time INTEGER,
+    claims INTEGER DEFAULT 0,
+    payload_id INTEGER,
 	FOREIGN KEY(administrator_id) REFERENCES administrators(id)
-);
\ No newline at end of file
+);
+
+-- With DEDUP_PAYLOADS each distinct payload is stored here once and
+-- jobs refer to it by payload_id, leaving their own json NULL
+CREATE TABLE IF NOT EXISTS payloads (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	hash TEXT UNIQUE,
+	json TEXT
+);
+
+-- Replacing a pool fills a new generation of jobs and then switches
+-- the active generation; older generations are deleted in the background
+CREATE TABLE IF NOT EXISTS generations (
+	administrator_id TEXT PRIMARY KEY,
+	active INTEGER,
+	latest INTEGER
+);
+
+-- Results handed in with /confirm, numbered in the order they came in
+CREATE TABLE IF NOT EXISTS results (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	administrator_id TEXT,
+	job_id INTEGER,
+	json TEXT,
+	complete_time INTEGER
+);
+
+-- How many of each generation's jobs have been moved to archived_jobs
+CREATE TABLE IF NOT EXISTS archived_counts (
+	administrator_id TEXT,
+	generation INTEGER,
+	count INTEGER,
+	PRIMARY KEY (administrator_id, generation)
+);
+
+-- Ready, pending and complete jobs of each generation, kept up to date
+-- by the triggers below in the same transaction as every change to jobs
+CREATE TABLE IF NOT EXISTS pool_counts (
+	administrator_id TEXT,
+	generation INTEGER,
+	ready INTEGER DEFAULT 0,
+	pending INTEGER DEFAULT 0,
+	complete INTEGER DEFAULT 0,
+	PRIMARY KEY (administrator_id, generation)
+);
+
+-- Counts the jobs of a database created before pool_counts existed
+INSERT OR IGNORE INTO pool_counts
+	SELECT administrator_id, generation, SUM(status='ready'),
+		SUM(status='pending'), SUM(status='complete')
+	FROM jobs WHERE NOT EXISTS (SELECT 1 FROM pool_counts)
+	GROUP BY administrator_id, generation;
+
+CREATE TRIGGER IF NOT EXISTS pool_counts_insert AFTER INSERT ON jobs
+BEGIN
+	INSERT OR IGNORE INTO pool_counts (administrator_id, generation)
+		VALUES (NEW.administrator_id, NEW.generation);
+	UPDATE pool_counts SET ready = ready + (NEW.status = 'ready'),
+		pending = pending + (NEW.status = 'pending'),
+		complete = complete + (NEW.status = 'complete')
+	WHERE administrator_id = NEW.administrator_id and generation = NEW.generation;
+END;
+
+CREATE TRIGGER IF NOT EXISTS pool_counts_update AFTER UPDATE OF status ON jobs
+WHEN OLD.status IS NOT NEW.status
+BEGIN
+	UPDATE pool_counts SET
+		ready = ready + (NEW.status = 'ready') - (OLD.status = 'ready'),
+		pending = pending + (NEW.status = 'pending') - (OLD.status = 'pending'),
+		complete = complete + (NEW.status = 'complete') - (OLD.status = 'complete')
+	WHERE administrator_id = OLD.administrator_id and generation = OLD.generation;
+END;
+
+CREATE TRIGGER IF NOT EXISTS pool_counts_delete AFTER DELETE ON jobs
+BEGIN
+	UPDATE pool_counts SET ready = ready - (OLD.status = 'ready'),
+		pending = pending - (OLD.status = 'pending'),
+		complete = complete - (OLD.status = 'complete')
+	WHERE administrator_id = OLD.administrator_id and generation = OLD.generation;
+END;
+
+-- Random selection seeks into this index at a random rand_key rather
+-- than sorting the whole pool with ORDER BY RANDOM()
+CREATE INDEX IF NOT EXISTS jobs_random_claim
+	ON jobs (administrator_id, generation, status, rand_key);
+
+-- Lets expire_jobs range scan only the pending jobs that are overdue
+CREATE INDEX IF NOT EXISTS jobs_expiry
+	ON jobs (status, expire_time);
+-- Finds the jobs a session already holds without scanning the pool;
+-- only pending jobs have a meaningful claimant
+CREATE INDEX IF NOT EXISTS jobs_claimant
+	ON jobs (administrator_id, claimant_uuid, generation) WHERE status='pending';
+
+-- Orders the pending fallback by how often each job has been handed
+-- out and then by how soon it expires, for PENDING_POLICY='least_claimed'
+CREATE INDEX IF NOT EXISTS jobs_pending_claims
+	ON jobs (administrator_id, generation, claims, expire_time) WHERE status='pending';
+
+-- Lets pruning check whether a payload is still referred to
+CREATE INDEX IF NOT EXISTS jobs_payload
+	ON jobs (payload_id) WHERE payload_id IS NOT NULL;
+
+-- Lets an export page through one generation of a pool in id order
+CREATE INDEX IF NOT EXISTS jobs_pool_id
+	ON jobs (administrator_id, generation, id);
+
+-- Lets /results page through one pool's results in id order
+CREATE INDEX IF NOT EXISTS results_pool
+	ON results (administrator_id, id);
+
+-- Let the archiver find old completed jobs, overall and per pool,
+-- without touching live ones
+CREATE INDEX IF NOT EXISTS jobs_complete
+	ON jobs (complete_time) WHERE status='complete';
+CREATE INDEX IF NOT EXISTS jobs_pool_complete
+	ON jobs (administrator_id, complete_time) WHERE status='complete';
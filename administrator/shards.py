@@ -0,0 +1,105 @@
+"""
+Storage shards
+
+With SHARDS set, each administrator_id's jobs live in a database file
+of their own (SHARDS = 'id') or in one of SHARDS files chosen by a hash
+of the id. Every shard has its own SQLite write lock, claim lock and
+expiry schedule, so a busy pool no longer holds up the others. Shard
+files sit next to DATABASE and are created on first use.
+"""
+
+from expiry import ExpiryScheduler
+from groupcommit import GroupCommitter
+from metrics import TimedLock
+import binascii
+import glob
+import hashlib
+import os
+import threading
+
+
+def shard_key(aid, shards):
+    """Names the shard that holds aid's jobs."""
+    aid = aid.encode('utf-8') if isinstance(aid, unicode) else str(aid)
+    if shards == 'id':
+        return hashlib.sha1(aid).hexdigest()[:16]
+    return str((binascii.crc32(aid) & 0xffffffff) % shards)
+
+def shard_path(database, key):
+    root, ext = os.path.splitext(database)
+    return '%s.shard-%s%s' % (root, key, ext)
+
+def shard_files(database):
+    """Returns the (key, path) of every shard file beside database."""
+    root, ext = os.path.splitext(database)
+    prefix = root + '.shard-'
+    files = []
+    for path in sorted(glob.glob(prefix + '*' + ext)):
+        key = path[len(prefix):len(path) - len(ext)]
+        # skips -wal and -shm files
+        if key.isalnum():
+            files.append((key, path))
+    return files
+
+
+class Shard(object):
+    """One database file, with the claim lock, expiry schedule and group
+    committer of the pools stored in it.
+    """
+
+    def __init__(self, database, metrics, recheck):
+        self.database = database
+        self.lock = TimedLock(threading.Lock(), metrics, 'get_lock')
+        self.expiry = ExpiryScheduler(recheck)
+        self.committer = None
+        self.committer_lock = threading.Lock()
+
+    def group_committer(self, pragmas, interval, size):
+        """Returns the shard's GroupCommitter, starting it if needed."""
+        with self.committer_lock:
+            if self.committer is None:
+                self.committer = GroupCommitter(self.database, pragmas,
+                                                interval, size)
+                self.committer.start()
+            return self.committer
+
+    def close(self):
+        with self.committer_lock:
+            if self.committer is not None:
+                self.committer.close()
+                self.committer = None
+
+
+class ShardSet(object):
+    def __init__(self, metrics, recheck):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.recheck = recheck
+        self.shards = {}
+
+    def get(self, database):
+        """Returns the Shard for database and whether it was new to
+        this process.
+        """
+        with self.lock:
+            shard = self.shards.get(database)
+            if shard is not None:
+                return shard, False
+
+            shard = self.shards[database] = Shard(database, self.metrics,
+                                                  self.recheck)
+            return shard, True
+
+    def all(self):
+        with self.lock:
+            return self.shards.values()
+
+    def forget(self, keep):
+        """Drops every shard but keep, and resets keep's expiry schedule.
+        Every shard's group committer is stopped.
+        """
+        with self.lock:
+            for shard in self.shards.values():
+                shard.expiry.forget()
+                shard.close()
+            self.shards = {keep.database: keep}
@@ -0,0 +1,95 @@
+"""
+Claim latency benchmark
+
+Fills a fresh database with pools of increasing size and times /get
+through the Flask test client. With indexed random selection the
+per-claim latency should stay flat as the pool grows.
+
+    python -m administrator.test.benchmark --sizes 1000,10000,100000,1000000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+from contextlib import closing
+
+import administrator
+from administrator.test.tests import HelperApp, remove_database
+
+bench_aid = "bench"
+
+def fill_pool(n, timeout=600, chunk=50000):
+    """Bulk load n ready jobs straight into the database."""
+    with administrator.app.app_context():
+        db = administrator.get_db()
+        with closing(db.cursor()) as c:
+            for start in xrange(0, n, chunk):
+                c.execute("BEGIN")
+                administrator.append_jobs(c,
+                    ((bench_aid, json.dumps({"job_secret": x}), None, timeout)
+                     for x in xrange(start, min(n, start + chunk))))
+                c.execute("COMMIT")
+
+def time_claims(claims):
+    app = HelperApp(bench_aid)
+    latencies = []
+    for i in xrange(claims):
+        start = time.time()
+        rv = app.get_job()
+        latencies.append(time.time() - start)
+        assert rv.status_code == 200, rv.data
+
+    latencies.sort()
+    return {"mean_ms": 1000 * sum(latencies) / len(latencies),
+            "p50_ms": 1000 * latencies[len(latencies) / 2],
+            "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)]}
+
+def run(sizes, claims, engine='sqlite'):
+    administrator.app.config['TESTING'] = True
+    administrator.app.config['TRACK_SESSION'] = False
+    administrator.app.config['ENGINE'] = engine
+
+    results = []
+    for n in sizes:
+        db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+        try:
+            administrator.init_db()
+            fill_pool(n)
+            if administrator.use_pool():
+                administrator.get_pool()
+            result = time_claims(min(claims, n))
+            result["jobs"] = n
+            results.append(result)
+        finally:
+            administrator.close_pool()
+            os.close(db_fd)
+            remove_database()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+        help='comma separated pool sizes')
+    parser.add_argument('--claims', type=int, default=500,
+        help='claims timed per pool size')
+    parser.add_argument('--engine', default='sqlite', choices=['sqlite', 'memory'],
+        help='job engine to benchmark')
+    parser.add_argument('--json', action='store_true',
+        help='print machine readable results')
+    args = parser.parse_args()
+
+    results = run([int(n) for n in args.sizes.split(',')], args.claims, args.engine)
+
+    if args.json:
+        print json.dumps(results)
+    else:
+        print "%10s %10s %10s %10s" % ("jobs", "mean ms", "p50 ms", "p99 ms")
+        for r in results:
+            print "%10d %10.3f %10.3f %10.3f" % (r["jobs"], r["mean_ms"],
+                r["p50_ms"], r["p99_ms"])
+
+if __name__ == '__main__':
+    main()
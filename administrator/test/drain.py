@@ -0,0 +1,144 @@
+"""
+Pool drain benchmark
+
+Drains a pool with threaded workers under each PENDING_POLICY and
+reports the duplicated work. Workers hold each job for about --job-time
+seconds before confirming it, and now and then walk away from a job
+without confirming it. Once the ready jobs run out every claim is a
+pending job someone else may already be working on, and any work whose
+confirm fails because the job was finished or re-claimed meanwhile is
+counted as duplicated.
+
+    python -m administrator.test.drain --jobs 200 --workers 4
+    python -m administrator.test.drain --policies random,least_claimed --json
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import administrator
+from administrator.test.benchmark import bench_aid, fill_pool
+from administrator.test.tests import HelperApp, remove_database
+
+class DrainWorker(threading.Thread):
+    """Claims and confirms jobs until the pool is drained or time is up."""
+
+    def __init__(self, job_time, abandon, deadline):
+        super(DrainWorker, self).__init__()
+        self.daemon = True
+        self.job_time = job_time
+        self.abandon = abandon
+        self.deadline = deadline
+        self.handed_out = 0
+        self.confirmed = 0
+        self.wasted = 0.0
+        self.abandoned = 0
+
+    def run(self):
+        app = HelperApp(bench_aid)
+        while time.time() < self.deadline:
+            rv = app.get_job()
+            if rv.status_code != 200:
+                return
+
+            self.handed_out += 1
+            job_id = json.loads(rv.data)['job_id']
+            work = self.job_time * random.uniform(0.5, 1.5)
+            time.sleep(work)
+
+            if random.random() < self.abandon:
+                # a new session, so the job is left to expire
+                self.abandoned += 1
+                app = HelperApp(bench_aid)
+            elif "Job confirmed complete" in app.confirm_job(job_id).data:
+                self.confirmed += 1
+            else:
+                self.wasted += work
+
+def drain(n, workers, job_time, timeout, abandon, duration):
+    fill_pool(n, timeout=timeout)
+    if administrator.use_pool():
+        administrator.get_pool()
+
+    start = time.time()
+    threads = [DrainWorker(job_time, abandon, start + duration)
+               for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    handed_out = sum(t.handed_out for t in threads)
+    return {"seconds": time.time() - start,
+            "handed_out": handed_out,
+            "confirmed": sum(t.confirmed for t in threads),
+            "abandoned": sum(t.abandoned for t in threads),
+            "duplicated": handed_out - n,
+            "duplicated_work_s": sum(t.wasted for t in threads)}
+
+def run(policies, n, workers, job_time, timeout, abandon, duration,
+        engine='sqlite'):
+    administrator.app.config['TESTING'] = True
+    administrator.app.config['TRACK_SESSION'] = True
+    administrator.app.config['ENGINE'] = engine
+
+    results = []
+    for policy in policies:
+        administrator.app.config['PENDING_POLICY'] = policy
+        db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+        try:
+            administrator.init_db()
+            result = drain(n, workers, job_time, timeout, abandon, duration)
+            result.update({"policy": policy, "engine": engine, "jobs": n,
+                           "workers": workers})
+            results.append(result)
+        finally:
+            administrator.close_pool()
+            os.close(db_fd)
+            remove_database()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--policies', default='random,least_claimed',
+        help='comma separated pending policies to compare')
+    parser.add_argument('--jobs', type=int, default=200,
+        help='jobs in the pool')
+    parser.add_argument('--workers', type=int, default=4,
+        help='concurrent workers')
+    parser.add_argument('--job-time', type=float, default=0.1,
+        help='mean seconds of work per job')
+    parser.add_argument('--timeout', type=int, default=3,
+        help='job timeout in seconds')
+    parser.add_argument('--abandon', type=float, default=0.2,
+        help='chance that a worker walks away from a job')
+    parser.add_argument('--duration', type=float, default=30,
+        help='longest each drain may take, in seconds')
+    parser.add_argument('--engine', default='sqlite', choices=['sqlite', 'memory'],
+        help='job engine to drain')
+    parser.add_argument('--json', action='store_true',
+        help='print machine readable results')
+    args = parser.parse_args()
+
+    results = run(args.policies.split(','), args.jobs, args.workers,
+                  args.job_time, args.timeout, args.abandon, args.duration,
+                  args.engine)
+
+    if args.json:
+        print json.dumps(results)
+    else:
+        print "%14s %8s %9s %10s %9s %10s %14s" % ("policy", "seconds",
+            "confirmed", "handed out", "abandoned", "duplicated", "duplicated s")
+        for r in results:
+            print "%14s %8.1f %9d %10d %9d %10d %14.1f" % (r["policy"], r["seconds"],
+                r["confirmed"], r["handed_out"], r["abandoned"], r["duplicated"],
+                r["duplicated_work_s"])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Load test
+
+Drives the app with a pool of threaded workers that claim a job, hold
+it for --job-time seconds and confirm it, for every combination of
+pool size and worker count. Runs against the Flask test client or a
+local gunicorn, and reports throughput, /get and /confirm latency,
+jobs handed out twice and get_lock contention. Once the ready jobs run
+out /get hands out pending ones, so duplicates are only a fault while
+the pool is larger than the number of jobs handed out.
+
+    python -m administrator.test.loadtest --jobs 1000,100000 --workers 1,8,32
+    python -m administrator.test.loadtest --target gunicorn --processes 4 --json
+"""
+
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib2
+
+import administrator
+from administrator.test.benchmark import bench_aid, fill_pool
+from administrator.test.tests import HelperApp, HttpHelperApp, \
+    remove_database, start_gunicorn, gunicorn
+
+class LoadWorker(threading.Thread):
+    """Claims and confirms jobs until the pool runs dry or time is up."""
+
+    def __init__(self, app, job_time, deadline):
+        super(LoadWorker, self).__init__()
+        self.daemon = True
+        self.app = app
+        self.job_time = job_time
+        self.deadline = deadline
+        self.latencies = {'/get': [], '/confirm': []}
+        self.job_ids = []
+        self.confirmed = 0
+        self.errors = 0
+
+    def timed(self, endpoint, f, *args):
+        start = time.time()
+        rv = f(*args)
+        self.latencies[endpoint].append(time.time() - start)
+        return rv
+
+    def run(self):
+        while time.time() < self.deadline:
+            rv = self.timed('/get', self.app.get_job)
+            if rv.status_code == 503:
+                return
+            if rv.status_code != 200:
+                self.errors += 1
+                continue
+
+            job_id = json.loads(rv.data)['job_id']
+            self.job_ids.append(job_id)
+
+            if self.job_time > 0:
+                time.sleep(self.job_time)
+
+            rv = self.timed('/confirm', self.app.confirm_job, job_id)
+            if "Job confirmed complete" in rv.data:
+                self.confirmed += 1
+            else:
+                self.errors += 1
+
+def percentiles(latencies):
+    if not latencies:
+        return {"count": 0}
+
+    latencies = sorted(latencies)
+    return {"count": len(latencies),
+            "p50_ms": 1000 * latencies[len(latencies) / 2],
+            "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)]}
+
+def lock_stats(text):
+    """Pulls get_lock's wait and hold totals out of /metrics text."""
+    stats = {}
+    for kind in ('wait', 'held'):
+        for part in ('sum', 'count'):
+            match = re.search(r'^administrator_lock_%s_seconds_%s\{lock="get_lock"\} (\S+)$'
+                              % (kind, part), text, re.M)
+            stats['%s_%s' % (kind, part)] = float(match.group(1)) if match else 0.0
+    return stats
+
+def lock_summary(before, after):
+    delta = dict((k, after[k] - before[k]) for k in after)
+    return {"wait_total_s": delta['wait_sum'],
+            "held_total_s": delta['held_sum'],
+            "wait_mean_ms": 1000 * delta['wait_sum'] / (delta['wait_count'] or 1),
+            "held_mean_ms": 1000 * delta['held_sum'] / (delta['held_count'] or 1)}
+
+def drive(make_app, scrape, workers, job_time, duration):
+    """Runs workers LoadWorkers against the pool and summarises them."""
+    before = lock_stats(scrape())
+    start = time.time()
+    threads = [LoadWorker(make_app(), job_time, start + duration)
+               for i in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    after = lock_stats(scrape())
+
+    handed_out = [job_id for t in threads for job_id in t.job_ids]
+    confirmed = sum(t.confirmed for t in threads)
+    return {"workers": workers,
+            "seconds": elapsed,
+            "confirmed": confirmed,
+            "throughput_per_s": confirmed / elapsed,
+            "duplicates": len(handed_out) - len(set(handed_out)),
+            "errors": sum(t.errors for t in threads),
+            "latency": dict((endpoint, percentiles(
+                                [l for t in threads for l in t.latencies[endpoint]]))
+                            for endpoint in ('/get', '/confirm')),
+            # gunicorn answers each scrape from one worker process only
+            "get_lock": lock_summary(before, after)}
+
+def run_test_client(workers, job_time, duration):
+    def scrape():
+        return administrator.app.test_client().get('/metrics').data
+
+    if administrator.use_pool():
+        administrator.get_pool()
+    return drive(lambda: HelperApp(bench_aid), scrape, workers, job_time, duration)
+
+def run_gunicorn(workers, job_time, duration, processes, engine):
+    settings = tempfile.NamedTemporaryFile(suffix='.cfg')
+    settings.write("DATABASE = %r\n" % administrator.app.config['DATABASE'])
+    settings.write("ENGINE = %r\n" % engine)
+    settings.write("SECRET_KEY = 'shared by every worker'\n")
+    settings.write("TRACK_SESSION = False\n")
+    settings.flush()
+
+    server, url = start_gunicorn(settings.name, processes)
+    try:
+        if url is None:
+            raise RuntimeError("gunicorn did not start")
+
+        def scrape():
+            return urllib2.urlopen(url + '/metrics').read()
+
+        result = drive(lambda: HttpHelperApp(bench_aid, url), scrape,
+                       workers, job_time, duration)
+        result["processes"] = processes
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+        settings.close()
+
+def run(sizes, worker_counts, job_time, duration, target='test', processes=1,
+        engine='sqlite'):
+    administrator.app.config['TESTING'] = True
+    administrator.app.config['TRACK_SESSION'] = False
+    administrator.app.config['ENGINE'] = engine
+
+    results = []
+    for n in sizes:
+        for workers in worker_counts:
+            db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+            try:
+                administrator.init_db()
+                fill_pool(n, timeout=max(600, 10 * duration))
+                if target == 'gunicorn':
+                    result = run_gunicorn(workers, job_time, duration,
+                                          processes, engine)
+                else:
+                    result = run_test_client(workers, job_time, duration)
+                result["jobs"] = n
+                result["target"] = target
+                result["engine"] = engine
+                results.append(result)
+            finally:
+                administrator.close_pool()
+                os.close(db_fd)
+                remove_database()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--jobs', default='1000,100000,1000000',
+        help='comma separated pool sizes')
+    parser.add_argument('--workers', default='1,8,32',
+        help='comma separated numbers of concurrent workers')
+    parser.add_argument('--job-time', type=float, default=0,
+        help='seconds each worker holds a job before confirming it')
+    parser.add_argument('--duration', type=float, default=10,
+        help='longest each run may take, in seconds')
+    parser.add_argument('--target', default='test', choices=['test', 'gunicorn'],
+        help='drive the Flask test client or a local gunicorn')
+    parser.add_argument('--processes', type=int, default=4,
+        help='gunicorn worker processes')
+    parser.add_argument('--engine', default='sqlite', choices=['sqlite', 'memory'],
+        help='job engine to load')
+    parser.add_argument('--json', action='store_true',
+        help='print machine readable results')
+    args = parser.parse_args()
+
+    if args.target == 'gunicorn' and not gunicorn:
+        parser.error("gunicorn is not installed")
+    if args.target == 'gunicorn' and args.engine == 'memory' and args.processes != 1:
+        parser.error("the memory engine only supports one gunicorn process")
+
+    results = run([int(n) for n in args.jobs.split(',')],
+                  [int(n) for n in args.workers.split(',')],
+                  args.job_time, args.duration, args.target, args.processes,
+                  args.engine)
+
+    if args.json:
+        print json.dumps(results)
+    else:
+        print "%9s %7s %9s %9s %9s %9s %9s %5s %10s" % ("jobs", "workers",
+            "jobs/s", "get p50", "get p99", "conf p50", "conf p99", "dups",
+            "lock wait")
+        for r in results:
+            get, conf = r["latency"]["/get"], r["latency"]["/confirm"]
+            print "%9d %7d %9.1f %9.3f %9.3f %9.3f %9.3f %5d %9.3fs" % (
+                r["jobs"], r["workers"], r["throughput_per_s"],
+                get.get("p50_ms", 0), get.get("p99_ms", 0),
+                conf.get("p50_ms", 0), conf.get("p99_ms", 0),
+                r["duplicates"], r["get_lock"]["wait_total_s"])
+
+if __name__ == '__main__':
+    main()
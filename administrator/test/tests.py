@@ -3,11 +3,23 @@ import tempfile
 import os
 import logging
 import administrator
+from administrator.shards import shard_files
+from administrator.groupcommit import GroupCommitter
 import sys
 import json
+import re
 import md5
+import pstats
+import shutil
 import time
 import threading
+import socket
+import subprocess
+import urllib2
+import cookielib
+import sqlite3
+from contextlib import closing, contextmanager
+from distutils.spawn import find_executable
 from random import randint
 from sets import Set
 
@@ -23,6 +35,68 @@ abc_aid = "abc"
 def gen_n_jobs(n):
     return [{"job_secret": x} for x in range(n)]
 
+def remove_database():
+    if administrator.collector is not None:
+        administrator.collector.flush()
+    administrator.db_pool.close_all()
+    database = administrator.app.config['DATABASE']
+    for path in [database] + [path for key, path in shard_files(database)]:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+
+def create_old_database():
+    """Replaces the database with one in the original schema, holding
+    jobs 1 to 3 of abc_aid: ready, pending since 2015, and complete.
+    """
+    remove_database()
+    with closing(sqlite3.connect(administrator.app.config['DATABASE'])) as db:
+        db.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, \
+            administrator_id TEXT, json TEXT, timeout INTEGER, status TEXT, \
+            claimant_uuid TEXT, expire_time TIMESTAMP)")
+        db.executemany("INSERT INTO jobs VALUES (?, ?, ?, 60, ?, ?, ?)",
+            [(1, abc_aid, '{"a": 1}', 'ready', None, None),
+             (2, abc_aid, '{"a": 2}', 'pending', 'x', '2015-01-01 00:00:00'),
+             (3, abc_aid, '{"a": 3}', 'complete', 'x', '2015-01-01 00:00:00'),
+             (5, abc_aid, '{"a": 5}', 'ready', None, None)])
+        db.execute("DELETE FROM jobs WHERE id=5")
+        db.commit()
+
+def check_only_integer_ids(test):
+    """Confirms and heartbeats with ids that are not JSON integers, which
+    int() would take for job 1, and checks that nothing happens to it.
+    """
+    test.app.add_jobs(abc_jobs, "real_password")
+    job_ids = [j['job_id'] for j in json.loads(test.app.get_jobs(3).data)]
+    test.assertIn(1, job_ids)
+
+    for job_id in (1.5, True, "1"):
+        test.assertIn("Job confirm failed", test.app.confirm_job(job_id).data)
+    rv = test.app.confirm_jobs([1.5, True, "1"])
+    test.assertEqual([r['result'] for r in json.loads(rv.data)['results']],
+                     ['not_found'] * 3)
+    rv = test.app.heartbeat([1.5, True, "1"])
+    test.assertEqual([r['result'] for r in json.loads(rv.data)['results']],
+                     ['not_found'] * 3)
+    test.assertIn("Job confirmed complete", test.app.confirm_job(1).data)
+
+@contextmanager
+def write_locked():
+    """Holds the database's write lock, with the server's connections
+    giving up on it after 50ms instead of waiting.
+    """
+    pragmas = administrator.app.config['SQLITE_PRAGMAS']
+    administrator.app.config['SQLITE_PRAGMAS'] = dict(pragmas, busy_timeout=50)
+    administrator.db_pool.close_all()
+    db = sqlite3.connect(administrator.app.config['DATABASE'], isolation_level=None)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        yield
+    finally:
+        db.close()
+        administrator.app.config['SQLITE_PRAGMAS'] = pragmas
+        administrator.db_pool.close_all()
+
 """
 Helper classes
 """
@@ -42,23 +116,149 @@ class HelperApp():
         return self.app.post('/add', data=json.dumps(data),
             content_type='application/json', follow_redirects=True)
 
-    def get_job(self):
+    def add_jobs_stream(self, jobs, password, mode="append", timeout=600):
+        header = {"administrator_id": self.admin_id,
+                  "timeout": timeout,
+                  "mode": mode,
+                  "password": password}
+        lines = [json.dumps(header)] + [json.dumps(j) for j in jobs]
+
+        return self.app.post('/add', data='\n'.join(lines) + '\n',
+            content_type='application/x-ndjson')
+
+    def get_job(self, wait=None):
         data = {"administrator_id": self.admin_id }
+        if wait is not None:
+            data["wait"] = wait
 
         return self.app.post('/get', content_type='application/json',
             data=json.dumps(data))
 
-    def confirm_job(self, job_id):
+    def get_jobs(self, count, wait=None):
+        data = {"administrator_id": self.admin_id,
+                "count": count}
+        if wait is not None:
+            data["wait"] = wait
+
+        return self.app.post('/get_batch', content_type='application/json',
+            data=json.dumps(data))
+
+    def confirm_job(self, job_id, result=None):
         data = {"administrator_id": self.admin_id,
                 "job_id": job_id}
+        if result is not None:
+            data["result"] = result
 
         return self.app.post('/confirm', content_type='application/json',
             data=json.dumps(data))
 
+    def confirm_jobs(self, job_ids, results=None):
+        data = {"administrator_id": self.admin_id,
+                "job_ids": job_ids}
+        if results is not None:
+            data["results"] = results
+
+        return self.app.post('/confirm_batch', content_type='application/json',
+            data=json.dumps(data))
+
+    def heartbeat(self, job_ids):
+        data = {"administrator_id": self.admin_id,
+                "job_ids": job_ids}
+
+        return self.app.post('/heartbeat', content_type='application/json',
+            data=json.dumps(data))
+
+    def get_results(self, password, after=0, limit=None):
+        data = {"administrator_id": self.admin_id,
+                "after": after,
+                "password": password}
+        if limit is not None:
+            data["limit"] = limit
+
+        rv = self.app.post('/results', content_type='application/json',
+            data=json.dumps(data))
+        if rv.status_code != 200:
+            return rv.status_code
+        return [json.loads(line) for line in rv.data.splitlines()]
+
+    def export_jobs(self, password):
+        data = {"administrator_id": self.admin_id,
+                "password": password}
+
+        return self.app.post('/export', content_type='application/json',
+            data=json.dumps(data))
+
+    def import_jobs(self, lines, password, mode="append", keep_ids=True):
+        header = {"administrator_id": self.admin_id,
+                  "mode": mode,
+                  "keep_ids": keep_ids,
+                  "password": password}
+
+        return self.app.post('/import', data='\n'.join([json.dumps(header)] + lines),
+            content_type='application/x-ndjson')
+
+class HttpResponse():
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.mimetype = headers.gettype()
+        self.data = data
+
+class HttpClient():
+    """Just enough of the Flask test client to drive a real server"""
+    def __init__(self, url):
+        self.url = url
+        self.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+
+    def post(self, path, data, content_type, follow_redirects=False):
+        req = urllib2.Request(self.url + path, data,
+                              {'Content-Type': content_type})
+        try:
+            rv = self.opener.open(req)
+        except urllib2.HTTPError, rv:
+            pass
+
+        return HttpResponse(rv.getcode(), rv.info(), rv.read())
+
+class HttpHelperApp(HelperApp):
+    def __init__(self, admin_id, url):
+        self.app = HttpClient(url)
+        self.admin_id = admin_id
+
+gunicorn = find_executable('gunicorn',
+    os.pathsep.join([os.path.dirname(sys.executable), os.environ.get('PATH', '')]))
+
+def start_gunicorn(settings, processes):
+    """Runs the app under gunicorn on a free local port, configured
+    from the settings file. Returns the server process and its URL, or
+    None for the URL if it did not start answering.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(administrator.__file__)))
+    env = dict(os.environ, ADMINISTRATOR_SETTINGS=settings)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([gunicorn, 'administrator:app',
+            '-w', str(processes), '-b', '127.0.0.1:%d' % port],
+            cwd=root, env=env, stdout=devnull, stderr=devnull)
+
+    url = 'http://127.0.0.1:%d' % port
+    for i in range(100):
+        try:
+            urllib2.urlopen(url + '/').read()
+            return server, url
+        except IOError:
+            time.sleep(0.1)
+
+    return server, None
+
 class Worker(threading.Thread):
-    def __init__(self, admin_id, job_time, start_time = 0):
+    def __init__(self, admin_id, job_time, start_time = 0, app = None):
         super(Worker, self).__init__()
-        self.app = HelperApp(admin_id)
+        self.app = app or HelperApp(admin_id)
         self.job_time = job_time
         self.start_time = start_time
         self.success = False
@@ -92,7 +292,7 @@ class AdministratorNoSessionTests(unittest.TestCase):
 
     def tearDown(self):
         os.close(self.db_fd)
-        os.unlink(administrator.app.config['DATABASE'])
+        remove_database()
 
     def test_all_jobs_unique(self):
         many = 25
@@ -110,6 +310,64 @@ class AdministratorNoSessionTests(unittest.TestCase):
         self.assertEqual(len(ids), many)
 
 
+@unittest.skipUnless(gunicorn, "gunicorn is not installed")
+class AdministratorMultiProcessTests(unittest.TestCase):
+    """
+    Runs the app under gunicorn with several worker processes, which
+    get_lock alone cannot keep from handing out the same job twice
+    """
+
+    def setUp(self):
+        self.db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+        self.config = tempfile.NamedTemporaryFile(suffix='.cfg')
+        self.config.write("DATABASE = %r\n" % administrator.app.config['DATABASE'])
+        self.config.write("PASSWORD_HASH = %r\n" % administrator.hash_password('real_password'))
+        self.config.write("SECRET_KEY = 'shared by every worker'\n")
+        self.config.write("TRACK_SESSION = False\n")
+        self.config.flush()
+        administrator.init_db()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+        self.config.close()
+        os.close(self.db_fd)
+        remove_database()
+
+    def start_server(self, processes):
+        self.server, self.url = start_gunicorn(self.config.name, processes)
+        if self.url is None:
+            self.fail("gunicorn did not start")
+
+    def check_all_jobs_unique(self, processes):
+        many = 50
+        self.start_server(processes)
+        HttpHelperApp(abc_aid, self.url).add_jobs(gen_n_jobs(many), "real_password")
+
+        workers = [Worker(abc_aid, 1, app=HttpHelperApp(abc_aid, self.url))
+                   for i in range(many)]
+        for w in workers:
+            w.start()
+
+        [w.join() for w in workers]
+
+        ids = Set()
+        for w in workers:
+            ids.add(w.job_id)
+
+        self.assertEqual(len(ids), many)
+        self.assertListEqual([w.success for w in workers],
+                             [True for w in workers])
+
+    def test_all_jobs_unique_4_processes(self):
+        self.check_all_jobs_unique(4)
+
+    def test_all_jobs_unique_16_processes(self):
+        self.check_all_jobs_unique(16)
+
+
 class AdministratorTests(unittest.TestCase):
 
     """
@@ -127,6 +385,10 @@ class AdministratorTests(unittest.TestCase):
         self.db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
         administrator.app.config['TESTING'] = True
         administrator.app.config['TRACK_SESSION'] = True
+        administrator.app.config['INGEST_CHUNK_SIZE'] = 10
+        administrator.app.config['COMPRESS_MIN_SIZE'] = None
+        administrator.app.config['DEDUP_PAYLOADS'] = False
+        administrator.app.config['WAIT_RECHECK'] = 1
         administrator.app.config['PASSWORD_HASH'] = administrator.hash_password('real_password')
         self.app = HelperApp(abc_aid)
         administrator.init_db()
@@ -137,7 +399,7 @@ class AdministratorTests(unittest.TestCase):
 
     def tearDown(self):
         os.close(self.db_fd)
-        os.unlink(administrator.app.config['DATABASE'])
+        remove_database()
 
     def test_add_jobs_password(self):
         log = logging.getLogger( "AdministratorTests.test_db_has_administrator_table")
@@ -163,6 +425,67 @@ class AdministratorTests(unittest.TestCase):
         rv = self.app.add_jobs(abc_jobs, "real_password", "replace")
         self.assertIn("Jobs replaced", rv.data)
 
+    def test_add_jobs_stream(self):
+        rv = self.app.add_jobs_stream(gen_n_jobs(25), "fake_password")
+        self.assertEqual(403, rv.status_code)
+
+        rv = self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "populate")
+        self.assertIn("Jobs appended (25 jobs)", rv.data)
+
+        rv = self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "populate")
+        self.assertIn("Not repopulating jobs", rv.data)
+
+        rv = self.app.add_jobs_stream(abc_jobs, "real_password", "replace")
+        self.assertIn("Jobs replaced (3 jobs)", rv.data)
+
+        payload = json.loads(self.app.get_job().data)["payload"]
+        self.assertIn(payload["job_secret"], "aaabbbccc")
+
+    def test_replace_switches_generation(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        old_id = json.loads(self.app.get_job().data)['job_id']
+
+        rv = self.app.add_jobs([{"job_secret": "ddd"}], "real_password", "replace")
+        self.assertIn("Jobs replaced", rv.data)
+
+        # the session's old job is gone along with its generation
+        rv = self.app.get_job()
+        self.assertEqual(json.loads(rv.data)['payload']['job_secret'], 'ddd')
+        self.assertIn("Job confirm failed", self.app.confirm_job(old_id).data)
+
+        administrator.collector.flush()
+        with administrator.app.app_context():
+            count = administrator.get_db().execute("SELECT COUNT(id) FROM jobs").fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_old_generations_collected_at_start(self):
+        self.app.add_jobs(abc_jobs, "real_password", "replace")
+        administrator.collector.flush()
+        # rows of a replaced generation whose collection a restart cut short
+        with administrator.app.app_context():
+            administrator.get_db().executemany("INSERT INTO jobs (administrator_id, \
+                json, timeout, status, generation) VALUES (?, '{}', 60, 'ready', 0)",
+                [(abc_aid,)] * 5)
+
+        administrator.app._got_first_request = False
+        self.assertEqual(self.stats(), (3, 0, 0))
+        administrator.collector.flush()
+        with administrator.app.app_context():
+            count = administrator.get_db().execute("SELECT COUNT(id) FROM jobs").fetchone()[0]
+        self.assertEqual(count, 3)
+
+    def test_failed_replace_keeps_pool(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+
+        data = '\n'.join([json.dumps({"administrator_id": abc_aid, "timeout": 600,
+                                       "mode": "replace", "password": "real_password"})]
+                         + [json.dumps(j) for j in gen_n_jobs(15)] + ['not json'])
+        rv = self.app.app.post('/add', data=data, content_type='application/x-ndjson')
+        self.assertEqual(400, rv.status_code)
+
+        payload = json.loads(self.app.get_job().data)["payload"]
+        self.assertIn(payload["job_secret"], "aaabbbccc")
+
     def test_get_job_empty(self):
         rv = self.app.get_job()
         self.assertEqual(503, rv.status_code)
@@ -183,6 +506,20 @@ class AdministratorTests(unittest.TestCase):
         payload = json.loads(rv.data)["payload"]
         self.assertIn(payload["job_secret"], "aaabbbccc")
 
+    def test_get_job_random(self):
+        self.app.add_jobs(gen_n_jobs(5), "real_password")
+
+        # each pick is uniform over fresh keys; keys are re-drawn on claim
+        seen = Set()
+        with administrator.app.app_context():
+            c = administrator.get_db().cursor()
+            for i in range(100):
+                c.execute("UPDATE jobs SET rand_key=" + administrator.RANDOM_KEY)
+                job_id, payload, timeout = administrator.select_random_job(c, abc_aid, 'ready')
+                seen.add(job_id)
+
+        self.assertEqual(len(seen), 5)
+
     def test_get_job_twice(self):
         rv = self.app.add_jobs(abc_jobs, "real_password")
         rv = self.app.get_job()
@@ -192,6 +529,604 @@ class AdministratorTests(unittest.TestCase):
 
         self.assertEqual(json.loads(rv.data)['job_id'], job_id)
 
+    def test_get_batch(self):
+        self.app.add_jobs(gen_n_jobs(5), "real_password")
+
+        rv = self.app.get_jobs(3)
+        self.assertEqual(rv.mimetype, 'application/json')
+        first = [j['job_id'] for j in json.loads(rv.data)]
+        self.assertEqual(len(Set(first)), 3)
+
+        # the session's jobs come back first, topped up with new ones
+        rv = self.app.get_jobs(5)
+        second = [j['job_id'] for j in json.loads(rv.data)]
+        self.assertEqual(len(Set(second)), 5)
+        self.assertTrue(Set(first) <= Set(second))
+
+        # falls back to pending jobs without handing out duplicates
+        rv = HelperApp(abc_aid).get_jobs(10)
+        self.assertEqual(len(Set(j['job_id'] for j in json.loads(rv.data))), 5)
+
+    def test_get_batch_count(self):
+        self.app.add_jobs(gen_n_jobs(5), "real_password")
+        self.app.get_jobs(3)
+
+        for count in (-1, 0, "x", None, 1.5):
+            self.assertEqual(self.app.get_jobs(count).status_code, 400)
+        self.assertEqual(len(json.loads(self.app.get_jobs("2").data)), 2)
+
+    def test_compressed_payloads(self):
+        administrator.app.config['COMPRESS_MIN_SIZE'] = 50
+        jobs = [{"job_secret": "a" * 100}, {"job_secret": u"\u00e9t\u00e9"}]
+        self.app.add_jobs(jobs, "real_password")
+
+        with administrator.app.app_context():
+            types = administrator.get_db().execute("SELECT typeof(json) FROM jobs \
+                ORDER BY id").fetchall()
+        self.assertEqual([t[0] for t in types], ['blob', 'text'])
+
+        rv = self.app.get_jobs(2)
+        payloads = sorted(j['payload'] for j in json.loads(rv.data))
+        self.assertEqual(payloads, sorted(jobs))
+
+    def test_dedup_payloads(self):
+        administrator.app.config['DEDUP_PAYLOADS'] = True
+        administrator.app.config['COMPRESS_MIN_SIZE'] = 50
+        jobs = [{"job_secret": "a" * 100}, {"job_secret": u"\u00e9t\u00e9"}] * 10
+        self.app.add_jobs(jobs, "real_password")
+        self.app.add_jobs_stream(jobs, "real_password")
+
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM payloads").fetchone()[0], 2)
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM jobs \
+                WHERE json IS NULL and payload_id IS NOT NULL").fetchone()[0], 40)
+
+        hits = administrator.payload_cache.hits
+        rv = self.app.get_jobs(40)
+        payloads = sorted(j['payload'] for j in json.loads(rv.data))
+        self.assertEqual(payloads, sorted(jobs * 2))
+        self.assertTrue(administrator.payload_cache.hits >= hits + 38)
+
+        # handed out again as the session's held jobs
+        rv = self.app.get_job()
+        self.assertIn(json.loads(rv.data)['payload'], jobs)
+
+    def test_dedup_payloads_pruned(self):
+        administrator.app.config['DEDUP_PAYLOADS'] = True
+        self.app.add_jobs(abc_jobs * 2, "real_password")
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+
+        # archived jobs keep their payload, and the live ones keep the payloads
+        administrator.archive_completed(age=-5)
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertIn(db.execute("SELECT json FROM archived_jobs").fetchone()[0],
+                          [json.dumps(j) for j in abc_jobs])
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM payloads").fetchone()[0], 3)
+
+        self.app.add_jobs([{"job_secret": "ddd"}], "real_password", "replace")
+        administrator.collector.flush()
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual([r[0] for r in db.execute("SELECT json FROM payloads")],
+                             [json.dumps({"job_secret": "ddd"})])
+
+    def test_get_wait_woken_by_add(self):
+        # long enough that only the add can wake the request in time
+        administrator.app.config['WAIT_RECHECK'] = 10
+
+        def add_later():
+            time.sleep(0.3)
+            HelperApp(abc_aid).add_jobs(abc_jobs, "real_password")
+        t = threading.Thread(target=add_later)
+        t.start()
+
+        start = time.time()
+        rv = self.app.get_job(wait=5)
+        t.join()
+        self.assertEqual(200, rv.status_code)
+        self.assertLess(time.time() - start, 3)
+
+    def test_get_wait_timeout(self):
+        administrator.app.config['WAIT_RECHECK'] = 0.1
+
+        start = time.time()
+        rv = self.app.get_jobs(3, wait=0.3)
+        self.assertEqual(503, rv.status_code)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+    def test_get_wait_invalid(self):
+        for path in ('/get', '/get_batch'):
+            data = {"administrator_id": abc_aid, "count": 1, "wait": None}
+            rv = self.app.app.post(path, content_type='application/json',
+                data=json.dumps(data))
+            self.assertEqual(503, rv.status_code)
+
+            for wait in ("x", True, [1], {}):
+                data["wait"] = wait
+                rv = self.app.app.post(path, content_type='application/json',
+                    data=json.dumps(data))
+                self.assertEqual(400, rv.status_code)
+
+    def test_metrics(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        self.app.app.get('/metrics')
+
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+
+        rv = self.app.app.get('/metrics')
+        self.assertIn('text/plain', rv.headers['Content-Type'])
+        for line in ['administrator_jobs{administrator_id="abc",status="ready"} 2',
+                     'administrator_jobs{administrator_id="abc",status="pending"} 0',
+                     'administrator_jobs{administrator_id="abc",status="complete"} 1',
+                     '# TYPE administrator_request_seconds histogram',
+                     'administrator_request_seconds_bucket{route="/get",le="+Inf"}']:
+            self.assertIn(line, rv.data)
+
+    def get_requests_timed(self):
+        data = self.app.app.get('/metrics').data
+        match = re.search(r'^administrator_request_seconds_count\{route="/get"\} (\d+)$',
+                          data, re.M)
+        return int(match.group(1)) if match else 0
+
+    def test_cors_preflight(self):
+        timed = self.get_requests_timed()
+        rv = self.app.app.open('/get', method='OPTIONS')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(rv.headers['Access-Control-Allow-Headers'], 'Content-Type')
+        self.assertEqual(sorted(rv.headers['Allow'].split(', ')), ['OPTIONS', 'POST'])
+        self.assertEqual(rv.headers['Access-Control-Allow-Methods'], rv.headers['Allow'])
+
+        # answered before Flask, so no request was timed
+        self.assertEqual(self.get_requests_timed(), timed)
+
+        self.app.add_jobs(abc_jobs, "real_password")
+        rv = self.app.get_job()
+        self.assertEqual(rv.headers['Access-Control-Allow-Origin'], '*')
+        self.assertEqual(sorted(rv.headers['Access-Control-Allow-Methods'].split(', ')),
+                         ['OPTIONS', 'POST'])
+
+    def stats(self):
+        rv = self.app.app.get('/stats?administrator_id=' + abc_aid)
+        counts = json.loads(rv.data)
+        return counts['ready'], counts['pending'], counts['complete']
+
+    def test_stats(self):
+        self.assertEqual(self.stats(), (0, 0, 0))
+        self.app.add_jobs(abc_jobs, "real_password", timeout=1)
+        job_ids = [j['job_id'] for j in json.loads(self.app.get_jobs(2).data)]
+        self.app.confirm_job(job_ids[0])
+        self.assertEqual(self.stats(), (1, 1, 1))
+
+        time.sleep(2.5)
+        with administrator.app.app_context():
+            administrator.expire_jobs(administrator.get_db())
+        self.assertEqual(self.stats(), (2, 0, 1))
+
+        self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "replace")
+        self.assertEqual(self.stats(), (25, 0, 0))
+
+        pools = json.loads(self.app.app.get('/stats').data)['pools']
+        self.assertEqual(pools, {abc_aid: {"ready": 25, "pending": 0, "complete": 0}})
+
+    def test_stats_match_jobs(self):
+        self.app.add_jobs(gen_n_jobs(30), "real_password")
+        for job in json.loads(self.app.get_jobs(10).data)[:5]:
+            self.app.confirm_job(job['job_id'])
+        administrator.archive_completed(age=-5)
+
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            counted = dict(db.execute("SELECT status, COUNT(id) FROM jobs \
+                GROUP BY status").fetchall())
+        self.assertEqual(self.stats(), (counted['ready'], counted['pending'], 0))
+
+    def test_profile(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        directory = tempfile.mkdtemp()
+        administrator.app.config['PROFILE_DIR'] = directory
+
+        def get(headers):
+            return self.app.app.post('/get', content_type='application/json',
+                data=json.dumps({"administrator_id": abc_aid}), headers=headers)
+
+        try:
+            rv = get({'X-Administrator-Profile': 'fake_password'})
+            self.assertNotIn('Server-Timing', rv.headers)
+            self.assertEqual(os.listdir(directory), [])
+
+            rv = get({'X-Administrator-Profile': 'real_password'})
+            self.assertIn('SELECT id, COALESCE(json, payload_id)', rv.headers['Server-Timing'])
+
+            # PROFILE profiles every request, adding up each endpoint's
+            administrator.app.config['PROFILE'] = True
+            job_id = json.loads(get({}).data)['job_id']
+            self.assertIn('UPDATE jobs', self.app.confirm_job(job_id).headers['Server-Timing'])
+
+            # the requests only add up their profiles; files come later
+            self.assertEqual(os.listdir(directory), [])
+            administrator.write_profiles()
+            self.assertEqual(sorted(os.listdir(directory)),
+                ['confirm.prof', 'confirm.sql.json', 'get.prof', 'get.sql.json'])
+            with open(os.path.join(directory, 'get.sql.json')) as f:
+                self.assertEqual(json.load(f)['requests'], 2)
+            stats = pstats.Stats(os.path.join(directory, 'get.prof'))
+            self.assertIn('claim_jobs', [name for path, line, name in stats.stats])
+        finally:
+            administrator.app.config['PROFILE'] = False
+            administrator.profiler.clear()
+            shutil.rmtree(directory)
+
+    def test_export_uses_index(self):
+        self.app.add_jobs(gen_n_jobs(20), "real_password")
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            db.execute("ANALYZE")
+            plan = db.execute("EXPLAIN QUERY PLAN SELECT jobs.id, \
+                COALESCE(jobs.json, payloads.json) FROM jobs LEFT JOIN payloads \
+                ON payloads.id = jobs.payload_id WHERE administrator_id=? \
+                and generation=? and jobs.id > ? ORDER BY jobs.id LIMIT ?",
+                (abc_aid, 1, 0, 10)).fetchall()
+        plan = ' '.join(str(tuple(r)) for r in plan)
+        self.assertIn('jobs_pool_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_export_import(self):
+        self.app.add_jobs(abc_jobs, "real_password", timeout=60)
+        held = json.loads(self.app.get_job().data)['job_id']
+        other = HelperApp(abc_aid)
+        other.confirm_job(json.loads(other.get_job().data)['job_id'])
+
+        administrator.app.config['EXPORT_BATCH_SIZE'] = 2
+        try:
+            self.assertEqual(self.app.export_jobs("fake_password").status_code, 403)
+            rv = self.app.export_jobs("real_password")
+        finally:
+            administrator.app.config['EXPORT_BATCH_SIZE'] = 1000
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+
+        lines = rv.data.splitlines()
+        self.assertEqual(json.loads(lines[0]), {"administrator_id": abc_aid})
+        jobs = [json.loads(line) for line in lines[1:]]
+        self.assertEqual([j['status'] for j in jobs].count('pending'), 1)
+        self.assertEqual(sorted(j['payload'] for j in jobs), sorted(abc_jobs))
+
+        # a new instance carries on with the same jobs and leases
+        os.close(self.db_fd)
+        remove_database()
+        self.db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+        administrator.init_db()
+
+        rv = self.app.import_jobs(lines[1:], "real_password")
+        self.assertIn("Jobs imported (3 jobs)", rv.data)
+        self.assertEqual(self.stats(), (1, 1, 1))
+        self.assertEqual(json.loads(self.app.get_job().data)['job_id'], held)
+        self.assertIn("Job confirmed complete", self.app.confirm_job(held).data)
+
+    def test_import_modes(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        lines = self.app.export_jobs("real_password").data.splitlines()[1:]
+
+        # the ids are taken, by the pool being replaced too
+        for mode in ("append", "replace"):
+            rv = self.app.import_jobs(lines, "real_password", mode)
+            self.assertEqual(rv.status_code, 409)
+            self.assertIn("keep_ids=false", rv.data)
+
+        # a replace that fails part way throws its staged jobs away
+        free = [json.dumps(dict(json.loads(lines[0]), id=100 + i)) for i in range(10)]
+        rv = self.app.import_jobs(free + lines, "real_password", "replace")
+        self.assertEqual(rv.status_code, 409)
+        self.assertIn("after 10 jobs", rv.data)
+        administrator.collector.flush()
+        self.assertEqual(self.stats(), (3, 0, 0))
+        with administrator.app.app_context():
+            self.assertEqual(administrator.get_db().execute("SELECT COUNT(id) \
+                FROM jobs").fetchone()[0], 3)
+
+        rv = self.app.import_jobs(lines, "real_password", "replace", keep_ids=False)
+        self.assertIn("Jobs replaced (3 jobs)", rv.data)
+        self.assertEqual(self.stats(), (3, 0, 0))
+
+        rv = self.app.import_jobs(['{"payload": 1}'], "real_password")
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(self.app.import_jobs(lines, "fake_password").status_code, 403)
+
+    def test_heartbeat(self):
+        self.app.add_jobs(abc_jobs, "real_password", timeout=60)
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        with administrator.app.app_context():
+            administrator.get_db().execute("UPDATE jobs SET expire_time=1 \
+                WHERE id=?", (job_id,))
+
+        rv = self.app.heartbeat([job_id, 12345])
+        results = json.loads(rv.data)['results']
+        self.assertEqual([r['result'] for r in results], ['extended', 'not_found'])
+        with administrator.app.app_context():
+            expire_time = administrator.get_db().execute("SELECT expire_time \
+                FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+        self.assertGreaterEqual(expire_time, administrator.epoch_now() + 59)
+
+        rv = HelperApp(abc_aid).heartbeat([job_id])
+        self.assertEqual(json.loads(rv.data)['results'][0]['result'], 'not_owned')
+
+        self.app.confirm_job(job_id)
+        rv = self.app.heartbeat([job_id])
+        self.assertEqual(json.loads(rv.data)['results'][0]['result'], 'already_complete')
+
+    def test_least_claimed_pending(self):
+        administrator.app.config['PENDING_POLICY'] = 'least_claimed'
+        try:
+            self.app.add_jobs(abc_jobs, "real_password")
+            self.app.get_jobs(3)
+            twice = json.loads(HelperApp(abc_aid).get_job().data)['job_id']
+
+            # every job is pending; the one handed out twice comes last
+            rv = HelperApp(abc_aid).get_jobs(2)
+            self.assertNotIn(twice, [j['job_id'] for j in json.loads(rv.data)])
+
+            # between jobs handed out as often, the closest to expiring
+            with administrator.app.app_context():
+                administrator.get_db().execute("UPDATE jobs SET expire_time=1 \
+                    WHERE id=?", (twice,))
+            self.assertEqual(json.loads(HelperApp(abc_aid).get_job().data)['job_id'],
+                             twice)
+        finally:
+            administrator.app.config['PENDING_POLICY'] = 'random'
+
+    def test_held_jobs_rechecked(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.assertEqual(json.loads(self.app.get_job().data)['job_id'], job_id)
+
+        # the job changes hands behind the cache's back, as it would in
+        # another server process
+        with administrator.app.app_context():
+            administrator.get_db().execute("UPDATE jobs SET claimant_uuid='other' \
+                WHERE id=?", (job_id,))
+
+        self.assertNotEqual(json.loads(self.app.get_job().data)['job_id'], job_id)
+
+    def test_held_jobs_chunked(self):
+        administrator.app.config['BATCH_LIMIT'] = 1001
+        try:
+            self.app.add_jobs(gen_n_jobs(1001), "real_password")
+            job_ids = set(j['job_id'] for j in json.loads(self.app.get_jobs(1001).data))
+            self.assertEqual(len(job_ids), 1001)
+
+            # the session resumes every cached job, looked up 500 at a time
+            resumed = set(j['job_id'] for j in json.loads(self.app.get_jobs(1001).data))
+            self.assertEqual(resumed, job_ids)
+        finally:
+            administrator.app.config['BATCH_LIMIT'] = 1000
+
+    def test_held_jobs_use_index(self):
+        with administrator.app.app_context():
+            plan = administrator.get_db().execute("EXPLAIN QUERY PLAN \
+                SELECT id, json FROM jobs WHERE administrator_id=? \
+                and claimant_uuid=? and status='pending' and generation=?",
+                (abc_aid, 'session', 0)).fetchall()
+        self.assertIn('jobs_claimant', ' '.join(str(tuple(r)) for r in plan))
+
+    def test_archive_completed(self):
+        self.app.add_jobs(abc_jobs[:1], "real_password")
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+
+        self.assertEqual(administrator.archive_completed(age=60), 0)
+        self.assertEqual(administrator.archive_completed(age=-5), 1)
+
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM jobs").fetchone()[0], 0)
+            self.assertEqual(db.execute("SELECT id FROM archived_jobs").fetchall()[0][0],
+                             job_id)
+            self.assertEqual(db.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+
+        # the archived job still counts, so the pool is not refilled
+        rv = self.app.add_jobs(abc_jobs, "real_password", "populate")
+        self.assertIn("Not repopulating jobs", rv.data)
+
+    def test_archive_keeps_reused_id(self):
+        self.app.add_jobs(abc_jobs[:1], "real_password")
+        lines = self.app.export_jobs("real_password").data.splitlines()[1:]
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+        self.assertEqual(administrator.archive_completed(age=-5), 1)
+
+        # the id is free in jobs again, so the dump loads with it
+        rv = self.app.import_jobs(lines, "real_password")
+        self.assertIn("Jobs imported (1 jobs)", rv.data)
+        self.assertEqual(json.loads(self.app.get_job().data)['job_id'], job_id)
+        self.app.confirm_job(job_id)
+
+        self.assertEqual(administrator.archive_completed(age=-5), 0)
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM jobs").fetchone()[0], 1)
+            self.assertEqual(db.execute("SELECT COUNT(id) FROM archived_jobs") \
+                .fetchone()[0], 1)
+
+    def test_archive_keep_newest(self):
+        other = HelperApp("xyz")
+        self.app.add_jobs(abc_jobs, "real_password")
+        other.add_jobs(abc_jobs[:1], "real_password")
+        job_ids = sorted(j['job_id'] for j in json.loads(self.app.get_jobs(3).data))
+        for job_id in job_ids:
+            self.app.confirm_job(job_id)
+        other.confirm_job(json.loads(other.get_job().data)['job_id'])
+
+        administrator.app.config['ARCHIVE_AGE'] = None
+        try:
+            self.assertEqual(administrator.archive_completed(keep=1), 2)
+            self.assertEqual(administrator.archive_completed(keep=1), 0)
+        finally:
+            administrator.app.config['ARCHIVE_AGE'] = 7 * 24 * 3600
+
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual([r[0] for r in db.execute("SELECT id FROM archived_jobs \
+                ORDER BY id")], job_ids[:2])
+            self.assertEqual([r[0] for r in db.execute("SELECT id FROM jobs \
+                WHERE administrator_id=?", (abc_aid,))], job_ids[2:])
+
+            plan = db.execute("EXPLAIN QUERY PLAN SELECT id, administrator_id, \
+                generation FROM jobs WHERE administrator_id=? and status='complete' \
+                ORDER BY complete_time, id LIMIT ?", (abc_aid, 1)).fetchall()
+            self.assertIn('jobs_pool_complete', ' '.join(str(tuple(r)) for r in plan))
+        self.assertEqual(self.stats(), (0, 0, 1))
+
+    def test_archive_to_separate_file(self):
+        fd, archive = tempfile.mkstemp()
+        administrator.app.config['ARCHIVE_DATABASE'] = archive
+        try:
+            self.app.add_jobs(abc_jobs, "real_password")
+            self.app.confirm_job(json.loads(self.app.get_job().data)['job_id'])
+            self.assertEqual(administrator.archive_completed(age=-5), 1)
+
+            with closing(sqlite3.connect(archive)) as db:
+                self.assertEqual(db.execute("SELECT COUNT(id) FROM archived_jobs") \
+                    .fetchone()[0], 1)
+        finally:
+            administrator.app.config['ARCHIVE_DATABASE'] = None
+            os.close(fd)
+            os.unlink(archive)
+
+    def test_shard_per_id(self):
+        administrator.app.config['SHARDS'] = 'id'
+        try:
+            other = HelperApp("xyz")
+            self.app.add_jobs(abc_jobs, "real_password")
+            other.add_jobs(abc_jobs[:1], "real_password")
+
+            database = administrator.app.config['DATABASE']
+            paths = [path for key, path in shard_files(database)]
+            self.assertEqual(len(paths), 2)
+            for path in paths:
+                with closing(sqlite3.connect(path)) as db:
+                    self.assertIn(db.execute("SELECT COUNT(id) FROM jobs") \
+                        .fetchone()[0], (1, 3))
+            with closing(sqlite3.connect(database)) as db:
+                self.assertEqual(db.execute("SELECT COUNT(id) FROM jobs") \
+                    .fetchone()[0], 0)
+
+            job_id = json.loads(other.get_job().data)['job_id']
+            self.assertIn("Job confirmed complete", other.confirm_job(job_id).data)
+            self.assertEqual(503, other.get_job().status_code)
+            self.assertEqual(len(json.loads(self.app.get_jobs(3).data)), 3)
+        finally:
+            administrator.app.config['SHARDS'] = None
+
+    def test_shard_connections_capped(self):
+        administrator.app.config['SHARDS'] = 'id'
+        administrator.app.config['SQLITE_MAX_CONNECTIONS'] = 2
+        try:
+            apps = [HelperApp(aid) for aid in ("a", "b", "c", "d")]
+            for app in apps:
+                app.add_jobs(abc_jobs, "real_password")
+
+            pools = json.loads(self.app.app.get('/stats').data)['pools']
+            self.assertEqual(sorted(pools), ["a", "b", "c", "d"])
+            db_stats = json.loads(self.app.app.get('/db_stats').data)
+            self.assertTrue(db_stats['open'] <= 2)
+            self.assertTrue(db_stats['evicted'] >= 3)
+
+            for app in apps:
+                self.assertEqual(200, app.get_job().status_code)
+        finally:
+            administrator.app.config['SHARDS'] = None
+            administrator.app.config['SQLITE_MAX_CONNECTIONS'] = 32
+
+    def test_shard_unknown_id(self):
+        administrator.app.config['SHARDS'] = 4
+        try:
+            self.assertEqual(503, HelperApp("xyz").get_job().status_code)
+            results = json.loads(HelperApp("xyz").confirm_jobs([1]).data)['results']
+            self.assertEqual(results[0]['result'], 'not_found')
+            self.assertEqual(shard_files(administrator.app.config['DATABASE']), [])
+        finally:
+            administrator.app.config['SHARDS'] = None
+
+    def test_get_batch_empty(self):
+        rv = self.app.get_jobs(3)
+        self.assertEqual(503, rv.status_code)
+        self.assertIn("No jobs available", rv.data)
+
+    def test_confirm_only_integer_ids(self):
+        check_only_integer_ids(self)
+
+    def test_confirm_batch(self):
+        self.app.add_jobs(abc_jobs, "real_password", timeout=1)
+        app2 = HelperApp(abc_aid)
+
+        mine = [j['job_id'] for j in json.loads(self.app.get_jobs(2).data)]
+        theirs = json.loads(app2.get_job().data)['job_id']
+
+        rv = self.app.confirm_jobs([mine[0], theirs, mine[0], 12345])
+        results = json.loads(rv.data)['results']
+        self.assertEqual([r['result'] for r in results],
+            ['confirmed', 'not_owned', 'already_complete', 'not_found'])
+
+        # let mine[1] time out and go back to the ready pool
+        time.sleep(2.5)
+        with administrator.app.app_context():
+            administrator.expire_jobs(administrator.get_db())
+
+        rv = self.app.confirm_jobs([mine[1]])
+        self.assertEqual(json.loads(rv.data)['results'][0]['result'], 'expired')
+
+    def test_confirm_results(self):
+        self.app.add_jobs(gen_n_jobs(5), "real_password")
+        administrator.app.config['COMPRESS_MIN_SIZE'] = 50
+        jobs = json.loads(self.app.get_jobs(5).data)
+
+        self.app.confirm_job(jobs[0]['job_id'], {"answer": "x" * 100})
+        self.app.confirm_job(jobs[1]['job_id'])
+        # only confirmed jobs keep their results
+        self.app.confirm_jobs([jobs[2]['job_id'], 12345, jobs[3]['job_id'], jobs[4]['job_id']],
+                              [u"\u00e9t\u00e9", "lost", None])
+        self.app.confirm_job(jobs[0]['job_id'], "too late")
+
+        self.assertEqual(self.app.get_results("fake_password"), 403)
+        found = self.app.get_results("real_password")
+        self.assertEqual([(r['job_id'], r['result']) for r in found],
+            [(jobs[0]['job_id'], {"answer": "x" * 100}),
+             (jobs[2]['job_id'], u"\u00e9t\u00e9")])
+
+        # a consumer picks up where it left off, a page at a time
+        administrator.app.config['RESULTS_BATCH_SIZE'] = 1
+        try:
+            self.assertEqual(self.app.get_results("real_password", limit=1), found[:1])
+            self.assertEqual(self.app.get_results("real_password", after=found[0]['id']),
+                             found[1:])
+        finally:
+            administrator.app.config['RESULTS_BATCH_SIZE'] = 1000
+
+    def test_results_paging_invalid(self):
+        for after in ("x", -1, 1.5, True, [1]):
+            self.assertEqual(self.app.get_results("real_password", after=after), 400)
+        for limit in ("x", -1, 1.5, True, {}):
+            self.assertEqual(self.app.get_results("real_password", limit=limit), 400)
+        self.assertEqual(self.app.get_results("real_password", after="0", limit="5"), [])
+
+    def test_confirm_fails_while_locked(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        job_id = json.loads(self.app.get_job().data)['job_id']
+
+        # the worker is told, so it keeps its result and tries again
+        with write_locked():
+            rv = self.app.confirm_job(job_id, "answer")
+        self.assertEqual(rv.status_code, 500)
+        self.assertEqual(self.stats(), (2, 1, 0))
+        self.assertEqual(self.app.get_results("real_password"), [])
+
+        self.assertIn("Job confirmed complete", self.app.confirm_job(job_id, "answer").data)
+        self.assertEqual(len(self.app.get_results("real_password")), 1)
+
     def test_exhaust_jobs(self):
         self.app.add_jobs(abc_jobs, "real_password")
 
@@ -294,6 +1229,92 @@ class AdministratorTests(unittest.TestCase):
         rv = self.app.get_job()
         self.assertNotIn("Job confirm failed", rv.data)
 
+    def test_db_connections_closed_with_thread(self):
+        self.app.add_jobs(gen_n_jobs(20), "real_password")
+        before = json.loads(self.app.app.get('/db_stats').data)
+
+        workers = [Worker(abc_aid, 0) for i in range(20)]
+        for w in workers:
+            w.start()
+        [w.join() for w in workers]
+
+        # a thread's locals are only freed a moment after join returns
+        for i in range(100):
+            after = json.loads(self.app.app.get('/db_stats').data)
+            if after['open'] == before['open']:
+                break
+            time.sleep(0.01)
+        self.assertTrue(after['opened'] >= before['opened'] + 20)
+        self.assertEqual(after['open'], before['open'])
+
+    def test_db_connections_reused(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        before = json.loads(self.app.app.get('/db_stats').data)
+
+        for i in range(5):
+            self.app.get_job()
+
+        after = json.loads(self.app.app.get('/db_stats').data)
+        self.assertEqual(after['opened'], before['opened'])
+        self.assertTrue(after['reused'] >= before['reused'] + 5)
+
+        with administrator.app.app_context():
+            mode = administrator.get_db().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+
+    def test_expire_only_when_due(self):
+        self.app.add_jobs(abc_jobs, "real_password", timeout=1)
+        self.app.get_job()
+
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            changes = db.total_changes
+
+            # the claimed job is not due yet, so nothing is written
+            administrator.expire_jobs(db)
+            self.assertEqual(db.total_changes, changes)
+
+            # the expired job, and its pool's row in pool_counts
+            time.sleep(2.5)
+            administrator.expire_jobs(db)
+            self.assertEqual(db.total_changes, changes + 2)
+
+    def test_migrate_old_jobs_table(self):
+        create_old_database()
+        administrator.init_db()
+        with administrator.app.app_context():
+            db = administrator.get_db()
+            self.assertEqual(db.execute("SELECT expire_time FROM jobs WHERE id=2") \
+                .fetchone()[0], 1420070400)
+            self.assertIsNotNone(db.execute("SELECT complete_time FROM jobs WHERE id=3") \
+                .fetchone()[0])
+            self.assertEqual(db.execute("SELECT name FROM sqlite_master \
+                WHERE name='jobs_old'").fetchall(), [])
+
+            # the long expired lease is swept like any other
+            administrator.expire_jobs(db)
+        self.assertEqual(self.stats(), (2, 0, 1))
+
+        claimed = [j['job_id'] for j in json.loads(self.app.get_jobs(5).data)]
+        self.assertEqual(sorted(claimed), [1, 2])
+        self.app.add_jobs([{"a": 6}], "real_password")
+        with administrator.app.app_context():
+            self.assertEqual(administrator.get_db().execute("SELECT MAX(id) FROM jobs") \
+                .fetchone()[0], 6)
+
+    def test_migrate_on_first_request(self):
+        create_old_database()
+        # as in a server process that has just started
+        administrator.app._got_first_request = False
+
+        rv = self.app.get_jobs(5)
+        self.assertEqual(200, rv.status_code)
+        self.assertIn(1, [j['job_id'] for j in json.loads(rv.data)])
+        with administrator.app.app_context():
+            names = [r[1] for r in administrator.get_db().execute("PRAGMA table_info(jobs)")]
+        self.assertIn('rand_key', names)
+        self.assertIn('generation', names)
+
     def test_all_jobs_unique(self):
         many = 25
         self.app.add_jobs(gen_n_jobs(many), "real_password")
@@ -321,6 +1342,72 @@ class AdministratorTests(unittest.TestCase):
         self.assertListEqual([w.success for w in workers],
                              [True for w in workers])
 
+    def test_group_commit(self):
+        administrator.app.config['GROUP_COMMIT'] = True
+        administrator.app.config['GROUP_COMMIT_INTERVAL'] = 0.05
+        try:
+            many = 25
+            self.app.add_jobs(gen_n_jobs(many), "real_password")
+            workers = [Worker(abc_aid, 1) for i in range(many)]
+            for w in workers:
+                w.start()
+
+            [w.join() for w in workers]
+
+            self.assertEqual(len(Set(w.job_id for w in workers)), many)
+            self.assertListEqual([w.success for w in workers],
+                                 [True for w in workers])
+
+            committer = administrator.main_shard().committer
+            self.assertEqual(committer.writes, 2 * many)
+            self.assertLess(committer.batches, committer.writes)
+        finally:
+            administrator.app.config['GROUP_COMMIT'] = False
+            administrator.app.config['GROUP_COMMIT_INTERVAL'] = 0.002
+            administrator.main_shard().close()
+
+    def test_group_commit_failure_is_isolated(self):
+        committer = GroupCommitter(administrator.app.config['DATABASE'], {},
+                                   interval=0.2)
+        committer.start()
+
+        def insert(c, name):
+            c.execute("INSERT INTO administrators (name) VALUES (?)", (name,))
+
+        def fail(c):
+            insert(c, "b")
+            raise ValueError("rolled back alone")
+
+        t = threading.Thread(target=committer.submit, args=(insert, "a"))
+        t.start()
+        self.assertRaises(ValueError, committer.submit, fail)
+        t.join()
+        committer.close()
+
+        self.assertEqual(committer.batches, 1)
+        with closing(sqlite3.connect(administrator.app.config['DATABASE'])) as db:
+            self.assertEqual(db.execute("SELECT name FROM administrators").fetchall(),
+                             [(u"a",)])
+
+    def test_group_commit_errors_reach_caller(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        administrator.app.config['GROUP_COMMIT'] = True
+        try:
+            job_id = json.loads(self.app.get_job().data)['job_id']
+
+            # a failed batch is neither an empty pool nor a confirmed job
+            with write_locked():
+                administrator.main_shard().close()
+                self.assertEqual(HelperApp(abc_aid).get_job().status_code, 500)
+                self.assertEqual(self.app.confirm_job(job_id).status_code, 500)
+            administrator.main_shard().close()
+
+            self.assertEqual(self.stats(), (2, 1, 0))
+            self.assertIn("Job confirmed complete", self.app.confirm_job(job_id).data)
+        finally:
+            administrator.app.config['GROUP_COMMIT'] = False
+            administrator.main_shard().close()
+
 
     # This test became unneccesary when pending jobs became up for grabs in lieu of open
     
@@ -374,5 +1461,291 @@ class AdministratorTests(unittest.TestCase):
             w.join()
 
 
+class AdministratorMemoryTests(unittest.TestCase):
+    def setUp(self):
+        self.db_fd, administrator.app.config['DATABASE'] = tempfile.mkstemp()
+        administrator.app.config['TESTING'] = True
+        administrator.app.config['TRACK_SESSION'] = True
+        administrator.app.config['INGEST_CHUNK_SIZE'] = 10
+        administrator.app.config['COMPRESS_MIN_SIZE'] = None
+        administrator.app.config['DEDUP_PAYLOADS'] = False
+        administrator.app.config['WAIT_RECHECK'] = 1
+        administrator.app.config['ENGINE'] = 'memory'
+        administrator.app.config['PASSWORD_HASH'] = administrator.hash_password('real_password')
+        self.app = HelperApp(abc_aid)
+        administrator.init_db()
+
+    def tearDown(self):
+        administrator.close_pool()
+        administrator.app.config['ENGINE'] = 'sqlite'
+        os.close(self.db_fd)
+        remove_database()
+
+    def test_add_jobs_modes(self):
+        rv = self.app.add_jobs(abc_jobs, "real_password", "populate")
+        self.assertIn("Jobs appended", rv.data)
+
+        rv = self.app.add_jobs(abc_jobs, "real_password", "populate")
+        self.assertIn("Not repopulating jobs", rv.data)
+
+        rv = self.app.add_jobs(abc_jobs, "real_password", "replace")
+        self.assertIn("Jobs replaced", rv.data)
+
+    def test_get_and_confirm(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+
+        rv = self.app.get_job()
+        job_id = json.loads(rv.data)['job_id']
+        self.assertIn(json.loads(rv.data)['payload']['job_secret'], "aaabbbccc")
+
+        # same session gets the same job back
+        rv = self.app.get_job()
+        self.assertEqual(json.loads(rv.data)['job_id'], job_id)
+
+        rv = HelperApp(abc_aid).confirm_job(job_id)
+        self.assertIn("Job confirm failed", rv.data)
+
+        rv = self.app.confirm_job(job_id)
+        self.assertIn("Job confirmed complete", rv.data)
+
+        rv = self.app.confirm_job(job_id)
+        self.assertIn("Job confirm failed", rv.data)
+
+    def test_exhaust_jobs(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+
+        apps = [HelperApp(abc_aid) for i in range(3)]
+        ids = [json.loads(app.get_job().data)['job_id'] for app in apps]
+        self.assertEqual(len(Set(ids)), 3)
+
+        for app, job_id in zip(apps, ids):
+            rv = app.confirm_job(job_id)
+            self.assertIn("Job confirmed complete", rv.data)
+
+        rv = self.app.get_job()
+        self.assertIn("No jobs available", rv.data)
+
+    def test_get_batch(self):
+        self.app.add_jobs(gen_n_jobs(5), "real_password")
+
+        first = [j['job_id'] for j in json.loads(self.app.get_jobs(3).data)]
+        self.assertEqual(len(Set(first)), 3)
+
+        second = [j['job_id'] for j in json.loads(self.app.get_jobs(5).data)]
+        self.assertEqual(len(Set(second)), 5)
+        self.assertTrue(Set(first) <= Set(second))
+
+        rv = HelperApp(abc_aid).get_jobs(10)
+        self.assertEqual(len(Set(j['job_id'] for j in json.loads(rv.data))), 5)
+
+        for job_id in second:
+            self.assertIn("Job confirm failed", self.app.confirm_job(job_id).data)
+
+    def test_confirm_only_integer_ids(self):
+        check_only_integer_ids(self)
+
+    def test_confirm_batch(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        app2 = HelperApp(abc_aid)
+
+        mine = [j['job_id'] for j in json.loads(self.app.get_jobs(2).data)]
+        theirs = json.loads(app2.get_job().data)['job_id']
+
+        rv = self.app.confirm_jobs([mine[0], theirs, mine[0], 12345])
+        results = json.loads(rv.data)['results']
+        self.assertEqual([r['result'] for r in results],
+            ['confirmed', 'not_owned', 'already_complete', 'not_found'])
+
+    def test_confirm_results(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        jobs = json.loads(self.app.get_jobs(3).data)
+
+        self.app.confirm_job(jobs[0]['job_id'], {"answer": 1})
+        self.app.confirm_jobs([jobs[1]['job_id'], jobs[2]['job_id']], [None, [2]])
+
+        found = self.app.get_results("real_password")
+        self.assertEqual([(r['job_id'], r['result']) for r in found],
+            [(jobs[0]['job_id'], {"answer": 1}), (jobs[2]['job_id'], [2])])
+
+    def test_add_jobs_stream(self):
+        rv = self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "populate")
+        self.assertIn("Jobs appended (25 jobs)", rv.data)
+
+        rv = self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "populate")
+        self.assertIn("Not repopulating jobs", rv.data)
+
+        rv = self.app.add_jobs_stream(abc_jobs, "real_password", "replace")
+        self.assertIn("Jobs replaced (3 jobs)", rv.data)
+
+        ids = Set(json.loads(HelperApp(abc_aid).get_job().data)['job_id']
+                  for i in range(3))
+        self.assertEqual(len(ids), 3)
+
+    def test_metrics(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        self.app.app.get('/metrics')
+
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+
+        rv = self.app.app.get('/metrics')
+        self.assertIn('text/plain', rv.headers['Content-Type'])
+        for line in ['administrator_jobs{administrator_id="abc",status="ready"} 2',
+                     'administrator_jobs{administrator_id="abc",status="pending"} 0',
+                     'administrator_jobs{administrator_id="abc",status="complete"} 1',
+                     '# TYPE administrator_request_seconds histogram',
+                     'administrator_request_seconds_bucket{route="/get",le="+Inf"}']:
+            self.assertIn(line, rv.data)
+
+    def test_get_wait_woken_by_add(self):
+        # long enough that only the add can wake the request in time
+        administrator.app.config['WAIT_RECHECK'] = 10
+
+        def add_later():
+            time.sleep(0.3)
+            HelperApp(abc_aid).add_jobs(abc_jobs, "real_password")
+        t = threading.Thread(target=add_later)
+        t.start()
+
+        start = time.time()
+        rv = self.app.get_job(wait=5)
+        t.join()
+        self.assertEqual(200, rv.status_code)
+        self.assertLess(time.time() - start, 3)
+
+    def test_stats(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        self.app.confirm_job(json.loads(self.app.get_job().data)['job_id'])
+
+        counts = json.loads(self.app.app.get('/stats?administrator_id=abc').data)
+        self.assertEqual(counts, {"administrator_id": "abc", "ready": 2,
+                                  "pending": 0, "complete": 1})
+
+    def test_heartbeat(self):
+        self.app.add_jobs(abc_jobs[:2], "real_password", timeout=1)
+        job_id = json.loads(self.app.get_job().data)['job_id']
+
+        # kept alive past its timeout, so the next claim does not expire it
+        for i in range(3):
+            time.sleep(0.7)
+            rv = self.app.heartbeat([job_id])
+            self.assertEqual(json.loads(rv.data)['results'][0]['result'], 'extended')
+
+        other = HelperApp(abc_aid)
+        self.assertNotEqual(json.loads(other.get_job().data)['job_id'], job_id)
+        self.assertEqual(json.loads(other.heartbeat([job_id]).data)
+                         ['results'][0]['result'], 'not_owned')
+        self.assertIn("Job confirmed complete", self.app.confirm_job(job_id).data)
+
+    def test_least_claimed_pending(self):
+        administrator.app.config['PENDING_POLICY'] = 'least_claimed'
+        try:
+            self.app.add_jobs(abc_jobs, "real_password")
+            self.app.get_jobs(3)
+            twice = json.loads(HelperApp(abc_aid).get_job().data)['job_id']
+
+            again = json.loads(HelperApp(abc_aid).get_job().data)['job_id']
+            self.assertNotEqual(again, twice)
+
+            # claim counts survive a reload from the journal
+            administrator.close_pool()
+            once = set(range(1, 4)) - set([twice, again])
+            self.assertEqual(json.loads(HelperApp(abc_aid).get_job().data)['job_id'],
+                             once.pop())
+        finally:
+            administrator.app.config['PENDING_POLICY'] = 'random'
+
+    def test_populate_after_archive(self):
+        self.app.add_jobs(abc_jobs[:1], "real_password")
+        self.app.confirm_job(json.loads(self.app.get_job().data)['job_id'])
+        administrator.close_pool()
+        administrator.archive_completed(age=-5)
+
+        rv = self.app.add_jobs(abc_jobs, "real_password", "populate")
+        self.assertIn("Not repopulating jobs", rv.data)
+
+    def test_compressed_payloads(self):
+        administrator.app.config['COMPRESS_MIN_SIZE'] = 50
+        jobs = [{"job_secret": "a" * 100}, {"job_secret": u"\u00e9t\u00e9"}]
+        self.app.add_jobs(jobs, "real_password")
+
+        # reloaded from the journal, compressed or not
+        administrator.close_pool()
+        rv = self.app.get_jobs(2)
+        payloads = sorted(j['payload'] for j in json.loads(rv.data))
+        self.assertEqual(payloads, sorted(jobs))
+
+    def test_load_dedup_payloads(self):
+        administrator.app.config['ENGINE'] = 'sqlite'
+        administrator.app.config['DEDUP_PAYLOADS'] = True
+        self.app.add_jobs(abc_jobs * 2, "real_password")
+
+        administrator.app.config['ENGINE'] = 'memory'
+        rv = self.app.get_jobs(6)
+        payloads = sorted(j['payload'] for j in json.loads(rv.data))
+        self.assertEqual(payloads, sorted(abc_jobs * 2))
+
+    def test_replace_switches_generation(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        old_id = json.loads(self.app.get_job().data)['job_id']
+
+        self.app.add_jobs_stream(gen_n_jobs(25), "real_password", "replace")
+
+        rv = self.app.get_job()
+        self.assertIn(json.loads(rv.data)['payload']['job_secret'], range(25))
+        self.assertIn("Job confirm failed", self.app.confirm_job(old_id).data)
+
+        # a restart only sees the new generation; one job is still held above
+        administrator.close_pool()
+        app = HelperApp(abc_aid)
+        ids = Set()
+        for i in range(24):
+            job_id = json.loads(app.get_job().data)['job_id']
+            app.confirm_job(job_id)
+            ids.add(job_id)
+        self.assertEqual(len(ids), 24)
+        self.assertNotIn(old_id, ids)
+
+    def test_hand_out_pending(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+
+        ids = [json.loads(HelperApp(abc_aid).get_job().data)['job_id']
+               for i in range(3)]
+
+        rv = self.app.get_job()
+        self.assertIn(json.loads(rv.data)['job_id'], ids)
+
+    def test_all_jobs_unique(self):
+        many = 25
+        self.app.add_jobs(gen_n_jobs(many), "real_password")
+        workers = [Worker(abc_aid, 1) for i in range(many)]
+        for w in workers:
+            w.start()
+
+        [w.join() for w in workers]
+
+        self.assertEqual(len(Set(w.job_id for w in workers)), many)
+        self.assertListEqual([w.success for w in workers],
+                             [True for w in workers])
+
+    def test_rebuild_from_journal(self):
+        self.app.add_jobs(abc_jobs, "real_password")
+        job_id = json.loads(self.app.get_job().data)['job_id']
+        self.app.confirm_job(job_id)
+        claimed_id = json.loads(self.app.get_job().data)['job_id']
+
+        # restart the engine from what was journaled
+        administrator.close_pool()
+
+        rv = self.app.get_job()
+        self.assertEqual(json.loads(rv.data)['job_id'], claimed_id)
+
+        rv = self.app.confirm_job(job_id)
+        self.assertIn("Job confirm failed", rv.data)
+
+        rv = self.app.confirm_job(claimed_id)
+        self.assertIn("Job confirmed complete", rv.data)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
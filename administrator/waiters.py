@@ -0,0 +1,54 @@
+"""
+Long-poll wake-ups
+
+A /get that asks to wait parks on a condition until jobs are added to
+its administrator_id or expired jobs return to a pool. Every notify
+bumps a version counter, and a waiter reads the version before it tries
+to claim, so a notify that lands between a failed claim and the wait
+is not lost.
+
+Only requests in this process are woken. Jobs added through other
+server processes are picked up when the waiter rechecks.
+"""
+
+import threading
+import time
+
+
+class Waiters(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+        # bumped by notifications meant for every administrator_id
+        self.everyone = 0
+        self.waiting = 0
+
+    def version(self, aid):
+        with self.condition:
+            return self.versions.get(aid, 0) + self.everyone
+
+    def notify(self, aid=None):
+        """Wakes the waiters for aid, or every waiter if aid is None."""
+        with self.condition:
+            if aid is None:
+                self.everyone += 1
+            else:
+                self.versions[aid] = self.versions.get(aid, 0) + 1
+            self.condition.notify_all()
+
+    def wait(self, aid, version, timeout):
+        """Blocks until aid is notified after version was read, or timeout
+        seconds pass. Returns whether it was notified.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self.versions.get(aid, 0) + self.everyone == version:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.waiting -= 1
@@ -1,4 +1,6 @@
 from flask.ext.script import Manager
+import json
+import sys
 
 import administrator
 
@@ -8,5 +10,53 @@ manager = Manager(administrator.app)
 def init_db():
     administrator.init_db()
 
+@manager.option('--age', type=int, default=None,
+                help='seconds since completion, defaults to ARCHIVE_AGE')
+@manager.option('--keep', type=int, default=None,
+                help='completed jobs kept per pool, defaults to ARCHIVE_KEEP')
+def archive(age, keep):
+    """Moves old completed jobs to the archive."""
+    print "Archived %d jobs" % administrator.archive_completed(age, keep)
+
+@manager.option('administrator_id')
+@manager.option('-o', '--output', default=None,
+                help='file to write, defaults to stdout')
+def dump(administrator_id, output):
+    """Dumps a pool's jobs, with their statuses and leases, as NDJSON."""
+    out = sys.stdout if output is None else open(output, 'w')
+    try:
+        for line in administrator.export_pool(administrator_id):
+            out.write(line)
+    finally:
+        if output is not None:
+            out.close()
+
+@manager.option('input', help='dump file, - for stdin')
+@manager.option('--administrator-id', default=None,
+                help='pool to load into, defaults to the dumped one')
+@manager.option('--mode', default='append', choices=['append', 'replace'])
+@manager.option('--new-ids', action='store_true',
+                help='number the jobs afresh instead of keeping their ids')
+def load(input, administrator_id, mode, new_ids):
+    """Loads a dump written by the dump command."""
+    lines = sys.stdin if input == '-' else open(input)
+    header = json.loads(next(lines))
+    jobs = (administrator.dump.parse_job(line) for line in lines if line.strip())
+
+    try:
+        message, count = administrator.import_chunks(
+            administrator_id or header['administrator_id'], mode, not new_ids,
+            administrator.chunked(jobs, administrator.app.config['INGEST_CHUNK_SIZE']))
+    except administrator.dump.IdsTaken, e:
+        print "%s, use --new-ids" % e
+        return
+    print "%s (%d jobs)" % (message or "Jobs not imported after", count)
+
+@manager.command
+def compact():
+    """Rewrites the databases so that incremental vacuum can free pages."""
+    for key, database in administrator.all_databases():
+        administrator.archiver.compact(database)
+
 if __name__ == "__main__":
     manager.run()
\ No newline at end of file